@@ -17,10 +17,9 @@ from database import db_session
 
 def getMasterCredentials():
 
-    aws_key = mixingboard.getConf("aws_key")
-    aws_secret = mixingboard.getConf("aws_secret")
+    conf = mixingboard.getConfMany(["aws_key", "aws_secret"])
 
-    return aws_key, aws_secret
+    return conf["aws_key"], conf["aws_secret"]
 
 def getEC2Conn(aws_key, aws_secret, region='us-west-2'):
 
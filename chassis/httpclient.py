@@ -0,0 +1,204 @@
+# Standard Library
+import logging
+import os
+import time
+from threading import Lock
+
+# Third Party
+import requests
+from requests.adapters import HTTPAdapter
+
+# Local
+
+
+logger = logging.getLogger(__name__)
+
+
+# hosts to keep connection pools for, and connections kept per host
+POOL_CONNECTIONS = 50
+POOL_MAXSIZE = 50
+
+# seconds to wait on a connect or between bytes of a response, long
+# enough for slow upstream calls (e.g. synchronous queries) but finite
+# so that a hung upstream can't hold a worker forever
+DEFAULT_TIMEOUT = 300
+
+# times to retry a request that failed to connect, only idempotent
+# methods are retried by default
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = 0.1
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+# retries across the process are limited to a fraction of requests so
+# that an upstream outage isn't multiplied by retries, every request
+# adds RETRY_BUDGET_RATIO of a retry to the budget up to RETRY_BUDGET_MAX
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MAX = 10
+
+global _session, _sessionPid, _retryBudget
+_session = None
+_sessionPid = None
+_sessionLock = Lock()
+_retryBudget = RETRY_BUDGET_MAX
+_retryBudgetLock = Lock()
+
+
+def configure(timeout=None, retries=None, poolConnections=None, poolMaxsize=None, retryBudgetRatio=None):
+    """
+    Changes the defaults used for inter-service requests. Pool
+    sizes apply to sessions created after this is called.
+
+    Args:
+        timeout: the default timeout in seconds
+        retries: the default number of retries for idempotent requests
+        poolConnections: the number of upstream hosts to pool connections for
+        poolMaxsize: the number of connections to keep per upstream host
+        retryBudgetRatio: the fraction of requests that may be retried
+    """
+
+    global DEFAULT_TIMEOUT, DEFAULT_RETRIES, POOL_CONNECTIONS, POOL_MAXSIZE, RETRY_BUDGET_RATIO
+
+    if timeout is not None:
+        DEFAULT_TIMEOUT = timeout
+    if retries is not None:
+        DEFAULT_RETRIES = retries
+    if poolConnections is not None:
+        POOL_CONNECTIONS = poolConnections
+    if poolMaxsize is not None:
+        POOL_MAXSIZE = poolMaxsize
+    if retryBudgetRatio is not None:
+        RETRY_BUDGET_RATIO = retryBudgetRatio
+
+
+def addArguments(argParser):
+    """
+    Adds the flags read by configureFromArgs to a service's arguments
+    """
+
+    argParser.add_argument('--http-timeout', type=float, default=DEFAULT_TIMEOUT, help='Seconds to wait on inter-service requests')
+    argParser.add_argument('--http-retries', type=int, default=DEFAULT_RETRIES, help='Times to retry idempotent inter-service requests that fail to connect')
+    argParser.add_argument('--http-retry-budget', type=float, default=RETRY_BUDGET_RATIO, help='The fraction of inter-service requests that may be retried')
+
+
+def configureFromArgs(args):
+    """
+    Configures inter-service requests from the flags added by addArguments
+    """
+
+    configure(timeout=args.http_timeout, retries=args.http_retries, retryBudgetRatio=args.http_retry_budget)
+
+
+def _depositRetry():
+
+    global _retryBudget
+
+    with _retryBudgetLock:
+        _retryBudget = min(_retryBudget + RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+
+
+def withdrawRetry():
+    """
+    Takes a retry from the process wide retry budget
+
+    Returns:
+        True if the budget allows another retry
+    """
+
+    global _retryBudget
+
+    with _retryBudgetLock:
+
+        if _retryBudget < 1:
+            return False
+
+        _retryBudget -= 1
+        return True
+
+
+def getSession():
+    """
+    Retrieves the process wide session. Sessions are recreated after
+    a fork (e.g. in celery workers) so that pooled sockets are never
+    shared between processes.
+
+    Returns:
+        a requests session with keep-alive connection pools
+    """
+
+    global _session, _sessionPid
+
+    with _sessionLock:
+
+        if _session is None or _sessionPid != os.getpid():
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+            _session = session
+            _sessionPid = os.getpid()
+
+        return _session
+
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    """
+    Makes a request over a pooled keep-alive connection, retrying
+    requests that fail to connect while the retry budget allows
+
+    Args:
+        method: an http method
+        url: the url to request
+        timeout: seconds to wait, defaults to DEFAULT_TIMEOUT
+        retries: times to retry on connection errors, defaults to
+            DEFAULT_RETRIES for idempotent methods and 0 otherwise
+        kwargs: any other arguments accepted by requests
+    Returns:
+        a requests response
+    """
+
+    method = method.upper()
+
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    if retries is None:
+        retries = DEFAULT_RETRIES if method in IDEMPOTENT_METHODS else 0
+
+    _depositRetry()
+
+    attempt = 0
+    while True:
+
+        try:
+
+            return getSession().request(method, url, timeout=timeout, **kwargs)
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+
+            if attempt >= retries or not withdrawRetry():
+                raise
+
+            logger.warning("Retrying %s %s after error: %s" % (method, url, e))
+            time.sleep(RETRY_BACKOFF * (2 ** attempt))
+            attempt += 1
+
+
+def get(url, **kwargs):
+
+    return request("GET", url, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+
+    return request("POST", url, data=data, **kwargs)
+
+
+def put(url, data=None, **kwargs):
+
+    return request("PUT", url, data=data, **kwargs)
+
+
+def delete(url, **kwargs):
+
+    return request("DELETE", url, **kwargs)
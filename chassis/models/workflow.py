@@ -163,6 +163,54 @@ class Workflow(Base):
     def __repr__(self):
         return '<WorkFlow %r>' % (self.title)
 
+def getStepDependencies(steps):
+    """
+    Finds the steps that each step of a workflow waits on. A step can
+    list the indexes of the steps it depends on in 'dependsOn'. A step
+    without 'dependsOn' depends on the step before it, which keeps
+    existing workflows running one step at a time.
+
+    Args:
+        steps: a list of workflow steps
+    Returns:
+        a list with the indexes of each step's dependencies
+    """
+
+    dependencies = []
+    for index, step in enumerate(steps):
+        if step.get('dependsOn') is not None:
+            dependencies.append(list(step['dependsOn']))
+        elif index > 0:
+            dependencies.append([index - 1])
+        else:
+            dependencies.append([])
+
+    return dependencies
+
+
+def findStepCycles(dependencies):
+    """
+    Args:
+        dependencies: a list as returned by getStepDependencies
+    Returns:
+        the indexes of any steps that can never run because they are
+        part of (or depend on) a dependency cycle
+    """
+
+    remaining = set(range(len(dependencies)))
+    resolved = set()
+
+    progress = True
+    while progress:
+        progress = False
+        for index in list(remaining):
+            if all(dependency in resolved for dependency in dependencies[index]):
+                remaining.remove(index)
+                resolved.add(index)
+                progress = True
+
+    return sorted(remaining)
+
 ###
 # EVENTS
 ###
@@ -226,6 +274,18 @@ def validateSteps(target, steps, oldSteps, initiator):
 
             errors[index].append("No step of type '%s'" % step['type'])
 
+        dependsOn = step.get('dependsOn')
+        if dependsOn is not None:
+
+            if type(dependsOn) != list or any([type(dependency) != int or dependency < 0 or dependency >= len(steps) \
+                                               or dependency == index for dependency in dependsOn]):
+                errors[index].append("A step can only depend on other steps in the same workflow")
+
+    if len(errors) == 0:
+
+        for index in findStepCycles(getStepDependencies(steps)):
+            errors[index].append("This step depends on itself through its dependencies")
+
     if len(errors) > 0:
         raise ValueError(dict(errors))
 
@@ -21,6 +21,47 @@ def makeHandle():
         int(time.time()*1000)
     )
 
+def normalizeTableName(table):
+    """
+    Qualifies a table name with its database so that 'foo' and
+    'default.foo' refer to the same table
+
+    Args:
+        table: a table name, optionally prefixed with a database
+    Returns:
+        a lower cased database.table name
+    """
+
+    table = table.strip().strip("`").lower()
+    if "." not in table:
+        table = "default.%s" % table
+
+    return table
+
+def tableVersionsKey(account):
+
+    return "tableversions:%s" % account
+
+def bumpTableVersion(redisClient, account, table):
+    """
+    Marks a table as changed, invalidating any cached query
+    results and metadata for it. The '<database>.*' version
+    tracks changes to the database's table list.
+
+    Args:
+        redisClient: a redis client
+        account: an account id
+        table: a table name
+    """
+
+    table = normalizeTableName(table)
+    database = table.split(".")[0]
+
+    pipe = redisClient.pipeline()
+    pipe.hincrby(tableVersionsKey(account), table, 1)
+    pipe.hincrby(tableVersionsKey(account), "%s.*" % database, 1)
+    pipe.execute()
+
 def processFormattedTableDescription(rows):
 
     section = ""
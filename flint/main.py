@@ -10,7 +10,7 @@ from collections import defaultdict
 
 # Third Party
 import mixingboard
-import requests
+from chassis import httpclient
 from chassis.aws import getS3Conn
 from chassis.database import db_session, init_db
 from chassis.models import Account, Job, JobHistory, RawDataset
@@ -29,7 +29,9 @@ argParser = argparse.ArgumentParser(description='Run the Quarry server.')
 argParser.add_argument('-d', '--debug', action='store_true', help='Run in debug mode')
 argParser.add_argument('-p', '--port', type=int, default=1988, help='Set the port')
 argParser.add_argument('-H', '--host', type=str, default='127.0.0.1', help='Set the host')
+httpclient.addArguments(argParser)
 args, _ = argParser.parse_known_args()
+httpclient.configureFromArgs(args)
 
 # put args in sensible all caps variables
 DEBUG = args.debug
@@ -258,14 +260,14 @@ def job_run(jobId):
 
     else:
     
-        jobServerInfo = mixingboard.getService('job-server', cluster=cluster, account=account)[0]
+        jobServerInfo = mixingboard.getBalancer('job-server', cluster=cluster, account=account, strategy="first").pick()
 
         baseJobUrl = "http://%s:%s/spark" % (jobServerInfo['host'], jobServerInfo['port'])
 
         mainFileData = job.getMainFileContents()
         files = {'file': ("main.py", mainFileData)}
         jobRunName = "%s_%s" % (job.title, int(time.time()))
-        res = requests.post(
+        res = httpclient.post(
             "%s/jobs/upload" % baseJobUrl,
             data = {
                 'account': account,
@@ -284,7 +286,7 @@ def job_run(jobId):
             extraFiles = {filename: (filename, contents)}
 
         if len(extraFiles) > 0:
-            res = requests.post(
+            res = httpclient.post(
                 "%s/jobs/%s/upload" % (
                     baseJobUrl,
                     jobRunName
@@ -301,7 +303,7 @@ def job_run(jobId):
                 return res.text, res.status_code
 
         options = dict(job.options.items() + requestOptions.items())
-        res = requests.post(
+        res = httpclient.post(
             "%s/job/%s/run" % (
                 baseJobUrl,
                 jobRunName
@@ -579,9 +581,8 @@ def spark(path):
     user = args.get('user') or form['user']
     cluster = args.get('cluster') or form['cluster']
 
-    jobServerInfo = mixingboard.getService('job-server', cluster=cluster, account=account)[0]
-
-    url = "http://%s:%s/spark/%s" % (jobServerInfo['host'], jobServerInfo['port'], path)
+    # job handles live on a single job server, so stick to the first healthy one
+    jobServer = mixingboard.getBalancer('job-server', "/spark/", cluster=cluster, account=account, strategy="first")
 
     files = {}
     if "file" in form:
@@ -595,7 +596,7 @@ def spark(path):
         uploadFile = request.files['file']
         files = {'file': (uploadFile.filename, uploadFile)}
 
-    res = getattr(requests, method.lower())(url, params=args, data=form, files=files)
+    res = jobServer.request(method, path, params=args, data=form, files=files)
 
     return res.text, res.status_code
     
@@ -1,10 +1,8 @@
 # Standard Library
-import logging
 from functools import wraps
 
 # Third Party
 import mixingboard
-import requests
 from chassis.models import Token, User 
 from flask import Blueprint, request, jsonify
 from jinja2 import TemplateNotFound
@@ -128,64 +126,12 @@ def get_raw_dataset_upload_url(user, datasetName):
 # Service Discovery
 ##
 
-# setup shark configurations
-global SHARK_URL_FORMAT
-SHARK_URL_FORMAT = None
-def setSharkURLFormat(sharkServers):
-    global SHARK_URL_FORMAT
-    shark = sharkServers[0]
-    SHARK_URL_FORMAT = "http://%s:%s/shark" % (shark["host"], shark["port"])
-    logging.info("GOT SHARK SERVICE: %s" % SHARK_URL_FORMAT)
-
-mixingboard.discoverService("shark",setSharkURLFormat)
-
-
-# setup lego configurations
-global LEGO_URL_FORMAT
-LEGO_URL_FORMAT = None
-def setLegoURLFormat(legoServers):
-    global LEGO_URL_FORMAT
-    lego = legoServers[0]
-    LEGO_URL_FORMAT = "http://%s:%s/lego" % (lego["host"], lego["port"])
-    logging.info("GOT LEGO SERVICE: %s" % LEGO_URL_FORMAT)
-
-mixingboard.discoverService("lego",setLegoURLFormat)
-
-
-# setup jaunt configurations
-global JAUNT_URL_FORMAT
-JAUNT_URL_FORMAT = None
-def setJauntURLFormat(jauntServers):
-    global JAUNT_URL_FORMAT
-    jauntServer = jauntServers[0]
-    JAUNT_URL_FORMAT = "http://%s:%s/jaunt" % (jauntServer["host"], jauntServer["port"])
-    logging.info("GOT JAUNT SERVICE: %s" % JAUNT_URL_FORMAT)
-
-mixingboard.discoverService("jaunt",setJauntURLFormat)
-
-
-# setup redshirt configurations
-global REDSHIRT_URL_FORMAT
-REDSHIRT_URL_FORMAT = None
-def setSharkURLFormat(redShirtServers):
-    global REDSHIRT_URL_FORMAT
-    redShirt = redShirtServers[0]
-    REDSHIRT_URL_FORMAT = "http://%s:%s/redshirt" % (redShirt["host"], redShirt["port"])
-    logging.info("GOT REDSHIRT SERVICE: %s" % REDSHIRT_URL_FORMAT)
-
-mixingboard.discoverService("redshirt",setSharkURLFormat)
-
-
-# setup flint configurations
-global FLINT_URL_FORMAT
-FLINT_URL_FORMAT = None
-def setFlintURLFormat(flintServers):
-    global FLINT_URL_FORMAT
-    flint = flintServers[0]
-    FLINT_URL_FORMAT = "http://%s:%s/flint" % (flint["host"], flint["port"])
-    logging.info("GOT FLINT SERVICE: %s" % FLINT_URL_FORMAT)
-
-mixingboard.discoverService("flint",setFlintURLFormat)
+# setup service balancers
+SHARK = mixingboard.getSharkBalancer("/shark")
+LEGO = mixingboard.getBalancer("lego", "/lego")
+JAUNT = mixingboard.getBalancer("jaunt", "/jaunt")
+REDSHIRT = mixingboard.getBalancer("redshirt", "/redshirt")
+FLINT = mixingboard.getBalancer("flint", "/flint")
 
 
 ##
@@ -195,10 +141,9 @@ mixingboard.discoverService("flint",setFlintURLFormat)
 
 def forwardRequest(user, service, path):
     
-    url = None
+    balancer = None
     if service == "flint":
-        url = FLINT_URL_FORMAT
-    url += path
+        balancer = FLINT
 
     args = dict(request.args.items())
     form = dict(request.form.items())
@@ -211,6 +156,6 @@ def forwardRequest(user, service, path):
     form['account'] = account_id
     form['user'] = user_id
 
-    res = getattr(requests, method.lower())(url, params=args, data=form)
+    res = balancer.request(method, path, params=args, data=form)
 
     return res.text, res.status_code
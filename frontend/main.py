@@ -10,8 +10,8 @@ import subprocess
 from functools import wraps
 
 # Third Party
-import requests
 import mixingboard
+from chassis import httpclient
 from chassis.database import db_session
 from chassis.models import User, Account, JobHistory, Notification, Token
 from flask import Flask, redirect, jsonify, render_template, request, \
@@ -28,7 +28,9 @@ argParser.add_argument('-d', '--debug', action='store_true', help='Turn on debug
 argParser.add_argument('-p', '--port', type=int, default=9000, help='Set the port')
 argParser.add_argument('-H', '--host', type=str, default='127.0.0.1', help='Set the port')
 argParser.add_argument('--no-sass', action='store_true', help='Disable sass compilation/watching')
+httpclient.addArguments(argParser)
 args, _ = argParser.parse_known_args()
+httpclient.configureFromArgs(args)
 
 # put args in sensible all caps variables
 DEBUG = args.debug
@@ -180,8 +182,6 @@ def jaunt(path):
     form = dict(request.form.items())
     method = request.method
 
-    url = "".join([JAUNT_URL_FORMAT, path])
-
     account = session['user']['account']['id']
     user = session['user']['id']
     args['account'] = account
@@ -204,7 +204,7 @@ def jaunt(path):
     args['warehouseDir'] = "/user/%s/shark/warehouse" % accountObj.iam_username
     form['warehouseDir'] = "/user/%s/shark/warehouse" % accountObj.iam_username
 
-    res = getattr(requests, method.lower())(url, params=args, data=form)
+    res = JAUNT.request(method, path, params=args, data=form)
 
     return res.text, res.status_code
 
@@ -222,8 +222,6 @@ def lego(path):
     form = dict(request.form.items())
     method = request.method
 
-    url = "".join([LEGO_URL_FORMAT, path])
-
     account = session['user']['account']['id']
     user = session['user']['id']
     args['account'] = account
@@ -231,7 +229,7 @@ def lego(path):
     form['account'] = account
     form['user'] = user
     
-    res = getattr(requests, method.lower())(url, params=args, data=form)
+    res = LEGO.request(method, path, params=args, data=form)
 
     return res.text, res.status_code
 
@@ -249,8 +247,6 @@ def shark(path):
     form = dict(request.form.items())
     method = request.method
 
-    url = "".join([SHARK_URL_FORMAT, path])
-
     account = session['user']['account']['id']
     user = session['user']['id']
     args['account'] = account
@@ -258,7 +254,7 @@ def shark(path):
     form['account'] = account
     form['user'] = user
     
-    res = getattr(requests, method.lower())(url, params=args, data=form)
+    res = SHARK.request(method, path, params=args, data=form)
 
     return res.text, res.status_code
 
@@ -276,8 +272,6 @@ def redshirt(path):
     form = dict(request.form.items())
     method = request.method
 
-    url = "".join([REDSHIRT_URL_FORMAT, path])
-
     account = session['user']['account']['id']
     user = session['user']['id']
     args['account'] = account
@@ -285,7 +279,7 @@ def redshirt(path):
     form['account'] = account
     form['user'] = user
 
-    res = getattr(requests, method.lower())(url, params=args, data=form)
+    res = REDSHIRT.request(method, path, params=args, data=form)
 
     return res.text, res.status_code
 
@@ -303,8 +297,6 @@ def flint(path):
     form = dict(request.form.items())
     method = request.method
 
-    url = "".join([FLINT_URL_FORMAT, path])
-
     account = session['user']['account']['id']
     user = session['user']['id']
     args['account'] = account
@@ -312,7 +304,7 @@ def flint(path):
     form['account'] = account
     form['user'] = user
 
-    res = getattr(requests, method.lower())(url, params=args, data=form)
+    res = FLINT.request(method, path, params=args, data=form)
 
     return res.text, res.status_code
 
@@ -519,64 +511,12 @@ def index():
     return render_template('base.html', user=json.dumps(session.get('user', None)))
 
 
-# setup shark configurations
-global SHARK_URL_FORMAT
-SHARK_URL_FORMAT = None
-def setSharkURLFormat(sharkServers):
-    global SHARK_URL_FORMAT
-    shark = sharkServers[0]
-    SHARK_URL_FORMAT = "http://%s:%s/shark/" % (shark["host"], shark["port"])
-    logging.info("GOT SHARK SERVICE: %s" % SHARK_URL_FORMAT)
-
-mixingboard.discoverService("shark",setSharkURLFormat) 
-
-
-# setup lego configurations
-global LEGO_URL_FORMAT
-LEGO_URL_FORMAT = None
-def setLegoURLFormat(legoServers):
-    global LEGO_URL_FORMAT
-    lego = legoServers[0]
-    LEGO_URL_FORMAT = "http://%s:%s/lego/" % (lego["host"], lego["port"])
-    logging.info("GOT LEGO SERVICE: %s" % LEGO_URL_FORMAT)
-
-mixingboard.discoverService("lego",setLegoURLFormat) 
-
-
-# setup jaunt configurations
-global JAUNT_URL_FORMAT
-JAUNT_URL_FORMAT = None
-def setJauntURLFormat(jauntServers):
-    global JAUNT_URL_FORMAT
-    jauntServer = jauntServers[0]
-    JAUNT_URL_FORMAT = "http://%s:%s/jaunt/" % (jauntServer["host"], jauntServer["port"])
-    logging.info("GOT JAUNT SERVICE: %s" % JAUNT_URL_FORMAT)
-
-mixingboard.discoverService("jaunt",setJauntURLFormat) 
-
-
-# setup redshirt configurations
-global REDSHIRT_URL_FORMAT
-REDSHIRT_URL_FORMAT = None
-def setSharkURLFormat(redShirtServers):
-    global REDSHIRT_URL_FORMAT
-    redShirt = redShirtServers[0]
-    REDSHIRT_URL_FORMAT = "http://%s:%s/redshirt/" % (redShirt["host"], redShirt["port"])
-    logging.info("GOT REDSHIRT SERVICE: %s" % REDSHIRT_URL_FORMAT)
-
-mixingboard.discoverService("redshirt",setSharkURLFormat) 
-
-
-# setup flint configurations
-global FLINT_URL_FORMAT
-FLINT_URL_FORMAT = None
-def setFlintURLFormat(flintServers):
-    global FLINT_URL_FORMAT
-    flint = flintServers[0]
-    FLINT_URL_FORMAT = "http://%s:%s/flint/" % (flint["host"], flint["port"])
-    logging.info("GOT FLINT SERVICE: %s" % FLINT_URL_FORMAT)
-
-mixingboard.discoverService("flint",setFlintURLFormat) 
+# setup service balancers
+SHARK = mixingboard.getSharkBalancer("/shark/")
+LEGO = mixingboard.getBalancer("lego", "/lego/")
+JAUNT = mixingboard.getBalancer("jaunt", "/jaunt/")
+REDSHIRT = mixingboard.getBalancer("redshirt", "/redshirt/")
+FLINT = mixingboard.getBalancer("flint", "/flint/")
 
 
 if __name__ == "__main__":
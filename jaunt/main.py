@@ -10,8 +10,8 @@ import traceback
 from threading import Thread
 
 # Third Party
-import requests
 import mixingboard
+from chassis import httpclient
 import yaml
 from chassis.models import Account, User, JobHistory, DataJob
 from chassis.database import db_session
@@ -30,7 +30,9 @@ argParser = argparse.ArgumentParser(description='Run the Quarry server.')
 argParser.add_argument('-d', '--debug', action='store_true', help='Turn on debug mode')
 argParser.add_argument('-p', '--port', type=int, default=9876, help='Set the port')
 argParser.add_argument('-H', '--host', type=str, default='127.0.0.1', help='Set the host')
+httpclient.addArguments(argParser)
 args, _ = argParser.parse_known_args()
+httpclient.configureFromArgs(args)
 
 # put args in sensible all caps variables
 DEBUG = args.debug
@@ -47,28 +49,9 @@ settingsFile.close()
 JOBS = settings["JOBS"]
 
 
-# setup shark server configurations
-global SHARK_URL_FORMAT
-SHARK_URL_FORMAT = None
-def setSharkURLFormat(sharkServers):
-    global SHARK_URL_FORMAT
-    shark = sharkServers[0]
-    SHARK_URL_FORMAT = "http://%s:%s/shark" % (shark["host"], shark["port"])
-    logging.info("GOT SHARK SERVICE: %s" % SHARK_URL_FORMAT)
-
-mixingboard.discoverService("shark",setSharkURLFormat)
-
-
-# setup flint configurations
-global FLINT_URL_FORMAT
-FLINT_URL_FORMAT = None
-def setFlintURLFormat(flintServers):
-    global FLINT_URL_FORMAT
-    flint = flintServers[0]
-    FLINT_URL_FORMAT = "http://%s:%s/flint/" % (flint["host"], flint["port"])
-    logging.info("GOT FLINT SERVICE: %s" % FLINT_URL_FORMAT)
-
-mixingboard.discoverService("flint",setFlintURLFormat)
+# setup service balancers
+SHARK = mixingboard.getSharkBalancer("/shark")
+FLINT = mixingboard.getBalancer("flint", "/flint/")
 
 
 # setup flask app
@@ -136,9 +119,7 @@ def juant_datasets():
         a list of importable database targets
     """
 
-    url = "".join([SHARK_URL_FORMAT, "/tables"])
-
-    res = requests.get(url, params=request.args)
+    res = SHARK.get("/tables", params=request.args)
 
     return jsonify({
         "datasets": res.json()['tables']
@@ -483,8 +464,7 @@ def jauntRunCommand(database, command, options):
                     cluster = options['cluster']
 
                     # upload the job to the job server
-                    uploadUrl = "%sspark/jobs/upload" % FLINT_URL_FORMAT
-                    res = requests.post(uploadUrl, 
+                    res = FLINT.post("spark/jobs/upload", 
                                         files=mainJobFiles, 
                                         data={
                                             "cluster": cluster,
@@ -494,8 +474,7 @@ def jauntRunCommand(database, command, options):
                                         })
 
                     # upload the job to the job server
-                    uploadUrl = "%sspark/jobs/%s/upload" % (FLINT_URL_FORMAT, jobName)
-                    res = requests.post(uploadUrl, 
+                    res = FLINT.post("spark/jobs/%s/upload" % jobName, 
                                         files=extraJobFiles, 
                                         data={
                                             "cluster": cluster,
@@ -503,9 +482,8 @@ def jauntRunCommand(database, command, options):
                                             "user": user
                                         })
 
-                    # run the job synchronously
-                    runUrl = "%sspark/job/%s/run" % (FLINT_URL_FORMAT, jobName)
-                    res = requests.post(runUrl, 
+                    # start the job, it runs in the background on the job server
+                    res = FLINT.post("spark/job/%s/run" % jobName, 
                                        data={
                                             "cluster": cluster,
                                             "options": json.dumps(sendOptions), 
@@ -513,6 +491,17 @@ def jauntRunCommand(database, command, options):
                                             "user": user
                                        })
 
+                    # markcuban invalidates results cached from the imported
+                    # table now and again once the import stops running
+                    if command == "import" and res.status_code == 200 and res.json().get('handle'):
+                        SHARK.post("/progress/notify", data={
+                            "cluster": cluster,
+                            "account": account,
+                            "user": user,
+                            "handle": res.json()['handle'],
+                            "table": sendOptions['sharkTable']
+                        })
+
                     return res.text, res.status_code
 
         else:
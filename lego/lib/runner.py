@@ -9,9 +9,9 @@ from uuid import getnode as get_mac
 # Third Party
 import mixingboard
 import redis
-import requests
 from celery import Celery
 from chassis.models import Workflow, User, Account, JobHistory
+from chassis.models.workflow import getStepDependencies
 from chassis.database import db_session
 from chassis.util import makeHandle
 
@@ -41,52 +41,40 @@ redisInfo = mixingboard.getConf('redis')
 redisClient = redis.StrictRedis(host=redisInfo['host'], port=int(redisInfo['port']), db=0)
 
 
-# setup shark configurations
-global SHARK_URL_FORMAT
-SHARK_URL_FORMAT = None
-def setSharkURLFormat(sharkServers):
-    global SHARK_URL_FORMAT
-    shark = sharkServers[0]
-    SHARK_URL_FORMAT = "http://%s:%s/shark" % (shark["host"], shark["port"])
-    logging.info("GOT SHARK SERVICE: %s" % SHARK_URL_FORMAT)
+# setup service balancers
+SHARK = mixingboard.getSharkBalancer("/shark")
+JAUNT = mixingboard.getBalancer("jaunt", "/jaunt")
+REDSHIRT = mixingboard.getBalancer("redshirt", "/redshirt")
+FLINT = mixingboard.getBalancer("flint", "/flint")
 
-mixingboard.discoverService("shark",setSharkURLFormat)
 
+# the most steps of a single workflow that run at once, and the
+# most workflow steps that run on a single cluster at once
+MAX_WORKFLOW_STEPS = 4
+MAX_CLUSTER_STEPS = 8
 
-# setup jaunt configurations
-global JAUNT_URL_FORMAT
-JAUNT_URL_FORMAT = None
-def setJauntURLFormat(jauntServers):
-    global JAUNT_URL_FORMAT
-    jauntServer = jauntServers[0]
-    JAUNT_URL_FORMAT = "http://%s:%s/jaunt" % (jauntServer["host"], jauntServer["port"])
-    logging.info("GOT JAUNT SERVICE: %s" % JAUNT_URL_FORMAT)
+# seconds to wait before retrying steps held back by the cluster limit
+CLUSTER_BUSY_RETRY = 30
 
-mixingboard.discoverService("jaunt",setJauntURLFormat)
+# seconds after which a step stops counting against its cluster's limit,
+# in case the task running it was lost
+CLUSTER_STEP_TIMEOUT = 6 * 60 * 60
 
+# seconds to keep the status and step bookkeeping of a finished workflow,
+# and to keep the state of a run that never finished
+FINISHED_TTL = 24 * 60 * 60
+RUN_TTL = 7 * 24 * 60 * 60
 
-# setup redshirt configurations
-global REDSHIRT_URL_FORMAT
-REDSHIRT_URL_FORMAT = None
-def setSharkURLFormat(redShirtServers):
-    global REDSHIRT_URL_FORMAT
-    redShirt = redShirtServers[0]
-    REDSHIRT_URL_FORMAT = "http://%s:%s/redshirt" % (redShirt["host"], redShirt["port"])
-    logging.info("GOT REDSHIRT SERVICE: %s" % REDSHIRT_URL_FORMAT)
+# running jobs are checked again as soon as markcuban publishes their
+# completion on this channel, and otherwise polled with a backoff
+JOB_EVENTS_CHANNEL = "jobevents"
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 60
+BOOT_POLL_INTERVAL = 10
 
-mixingboard.discoverService("redshirt",setSharkURLFormat)
-
-
-# setup flint configurations
-global FLINT_URL_FORMAT
-FLINT_URL_FORMAT = None
-def setFlintURLFormat(flintServers):
-    global FLINT_URL_FORMAT
-    flint = flintServers[0]
-    FLINT_URL_FORMAT = "http://%s:%s/flint" % (flint["host"], flint["port"])
-    logging.info("GOT FLINT SERVICE: %s" % FLINT_URL_FORMAT)
-
-mixingboard.discoverService("flint",setFlintURLFormat)
+# the attempt checks triggered by a completion event run with, they never
+# schedule another check since the job's polling chain is still running
+WOKEN_ATTEMPT = -1
 
 
 def makeHistory(accountId, userId, event, jobId=None, jobHandle=None, data={}):
@@ -110,9 +98,60 @@ def makeHistory(accountId, userId, event, jobId=None, jobHandle=None, data={}):
     return jobHistory
 
 
-def getHandleInfo(handle):
-
-    info = redisClient.hgetall('workflow:%s' % handle)
+# a workflow counts as running while its status was updated within
+# this many seconds, it has to cover the longest wait between polls
+RUNNING_WINDOW = 5 * 60
+
+# updates a workflow's status and its place in the account's running
+# workflows in one round trip, statuses of runs that never finish expire
+# along with the rest of the run's state
+#   KEYS: the status hash, the account's running workflows sorted set
+#   ARGV: the handle, the time, 1 if finished, the finished ttl, the run
+#         ttl, the oldest time still running, then the status fields and values
+SET_HANDLE_INFO = redisClient.register_script("""
+redis.call('HMSET', KEYS[1], unpack(ARGV, 7))
+if ARGV[3] == '1' or redis.call('HEXISTS', KEYS[1], 'cancelled') == 1 then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+else
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+end
+if ARGV[3] == '1' then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+elseif redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[6])
+""")
+
+# marks a workflow cancelled without recreating the status of a run that
+# finished, expired or never existed, the status keeps its ttl
+#   KEYS: the status hash
+#   ARGV: the cancelled value
+#   returns 1 if the workflow was marked cancelled
+CANCEL_HANDLE = redisClient.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'cancelled', ARGV[1])
+return 1
+""")
+
+# reads the status of every running workflow of an account in one round trip
+#   KEYS: the account's running workflows sorted set
+#   ARGV: the oldest time still running, the status hash key prefix
+#   returns a flat list of handles each followed by its status fields
+GET_RUNNING_WORKFLOWS = redisClient.register_script("""
+local handles = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf')
+local result = {}
+for _, handle in ipairs(handles) do
+    result[#result + 1] = handle
+    result[#result + 1] = redis.call('HGETALL', ARGV[2] .. handle)
+end
+return result
+""")
+
+
+def unpackHandleInfo(handle, info):
 
     dumpedInfo = {}
     for key, value in info.items():
@@ -123,22 +162,37 @@ def getHandleInfo(handle):
     return dumpedInfo
 
 
+def getHandleInfo(handle):
+
+    return unpackHandleInfo(handle, redisClient.hgetall('workflow:%s' % handle))
+
+
 def isCancelled(handle):
-    
-    return redisClient.hget('workflow:%s' % handle, "cancelled")
+    """
+    Returns:
+        whether a workflow has been cancelled or has already finished,
+        e.g. because a step running alongside this one failed
+    """
+
+    pipe = redisClient.pipeline()
+    pipe.hexists('workflow:%s' % handle, "cancelled")
+    pipe.exists('workflow:%s:finished' % handle)
+    cancelled, finished = pipe.execute()
+
+    return cancelled or finished
 
 
 def setHandleInfo(handle, account, user, **kwargs):
 
-    cancelled = redisClient.hget('workflow:%s' % handle, "cancelled")
+    now = int(time.time())
 
-    if kwargs.get('finished') or cancelled:
-        redisClient.zrem("workflows:%s" % account, handle)
-    else:
-        redisClient.zadd("workflows:%s" % account, int(time.time()), handle)
-        # TODO remove workflows that have a timestamp greater than X seconds old
+    fields = []
+    for key, value in kwargs.items():
+        fields.extend([key, json.dumps(value)])
 
-    redisClient.hmset('workflow:%s' % handle, {key: json.dumps(value) for key, value in kwargs.items()})
+    SET_HANDLE_INFO(keys=['workflow:%s' % handle, "workflows:%s" % account],
+                    args=[handle, now, 1 if kwargs.get('finished') else 0, FINISHED_TTL, RUN_TTL,
+                          now - RUNNING_WINDOW] + fields)
 
     if 'message' in kwargs:
         logger.info(kwargs['message'])
@@ -146,39 +200,262 @@ def setHandleInfo(handle, account, user, **kwargs):
 
 def cancelHandle(handle):
 
-    redisClient.hmset('workflow:%s' % handle, {"cancelled": json.dumps(True)})
+    CANCEL_HANDLE(keys=['workflow:%s' % handle], args=[json.dumps(True)])
     return getHandleInfo(handle)
 
 
 def getRunningWorkflows(account, user):
 
-    handles = redisClient.zrangebyscore("workflows:%s" % account, int(time.time())-60, '+inf')
+    result = GET_RUNNING_WORKFLOWS(keys=["workflows:%s" % account],
+                                   args=[int(time.time()) - RUNNING_WINDOW, 'workflow:'])
+
     infos = []
-    for handle in handles:
-        infos.append(getHandleInfo(handle))
+    for i in range(0, len(result), 2):
+        fields = result[i + 1]
+        infos.append(unpackHandleInfo(result[i], dict(zip(fields[::2], fields[1::2]))))
 
     return infos
 
 
+def runKey(handle, part):
+    """
+    Args:
+        handle: a workflow handle
+        part: 'definition' for the workflow being run or 'options' for its run options
+    Returns:
+        the key the part of a run's state is stored under
+    """
+
+    return 'workflow:%s:%s' % (handle, part)
+
+
+def loadRun(handle, stepIndex=None):
+    """
+    Loads the state of a workflow run. Tasks only pass the run's handle
+    and the index of their step around, everything else lives in redis.
+
+    Args:
+        handle: a workflow handle
+        stepIndex: the index of a step in the workflow
+    Returns:
+        the workflow dictionary, the run options and the step (or None),
+        the workflow is None if the run no longer exists
+    """
+
+    pipe = redisClient.pipeline()
+    pipe.get(runKey(handle, 'definition'))
+    pipe.hgetall(runKey(handle, 'options'))
+    workflow, options = pipe.execute()
+
+    if workflow is None:
+        logger.error("No workflow run exists with the handle '%s'" % handle)
+        return None, None, None
+
+    workflow = json.loads(workflow)
+    options = {key: json.loads(value) for key, value in options.items()}
+
+    step = None
+    if stepIndex is not None:
+        step = dict(workflow['steps'][stepIndex])
+        step['index'] = stepIndex
+
+    return workflow, options, step
+
+
+def setRunOptions(handle, **kwargs):
+
+    # the options of a lost run expire like the rest of its state
+    pipe = redisClient.pipeline()
+    pipe.hmset(runKey(handle, 'options'), {key: json.dumps(value) for key, value in kwargs.items()})
+    pipe.expire(runKey(handle, 'options'), RUN_TTL)
+    pipe.execute()
+
+
 def runWorkflow(workflow, options={}):
 
     handle = makeHandle()
 
     workflow = workflow.dict()
 
+    # runs whose tasks were lost never finish, so their state expires eventually
+    pipe = redisClient.pipeline()
+    pipe.set(runKey(handle, 'definition'), json.dumps(workflow), ex=RUN_TTL)
+    if len(options) > 0:
+        pipe.hmset(runKey(handle, 'options'), {key: json.dumps(value) for key, value in options.items()})
+        pipe.expire(runKey(handle, 'options'), RUN_TTL)
+    pipe.execute()
+
     setHandleInfo(handle, workflow['account_id'], workflow['user_id'], totalSteps=len(workflow['steps']), stepsComplete=0, finished=False,
                   started=int(time.time()*1000), title=workflow['title'], message="Warming up...")
-    options['stepsComplete'] = -1
 
     makeHistory(workflow['account_id'], workflow['user_id'], "start_workflow", workflow['id'], handle)
 
-    nextWorkflowStep(workflow, options, handle)
+    nextWorkflowStep(handle)
 
     return handle
 
 
+def stepsKey(handle, state):
+    """
+    Args:
+        handle: a workflow handle
+        state: 'started' or 'done'
+    Returns:
+        the key of the set of step indexes of a workflow in that state
+    """
+
+    return 'workflow:%s:%s' % (handle, state)
+
+
+def clusterStepsKey(account, cluster):
+
+    return 'clustersteps:%s:%s' % (account, cluster)
+
+
+def claimClusterSlot(account, cluster, handle, index):
+    """
+    Counts a step against its cluster's limit of running steps
+
+    Returns:
+        False if the cluster is already running as many steps as it's allowed
+    """
+
+    key = clusterStepsKey(account, cluster)
+    member = "%s:%s" % (handle, index)
+    now = time.time()
+
+    pipe = redisClient.pipeline()
+    pipe.zremrangebyscore(key, '-inf', now - CLUSTER_STEP_TIMEOUT)
+    pipe.zadd(key, now, member)
+    pipe.zcard(key)
+    runningSteps = pipe.execute()[-1]
+
+    if runningSteps > MAX_CLUSTER_STEPS:
+        redisClient.zrem(key, member)
+        return False
+
+    return True
+
+
+def releaseClusterSlots(account, cluster, handle, indexes):
+
+    if cluster and len(indexes) > 0:
+        redisClient.zrem(clusterStepsKey(account, cluster), *["%s:%s" % (handle, index) for index in indexes])
+
+
+def pollDelay(attempt):
+
+    return min(MIN_POLL_INTERVAL * 2 ** attempt, MAX_POLL_INTERVAL)
+
+
+def jobWaitKey(jobHandle):
+
+    return 'jobwait:%s' % jobHandle
+
+
+def waitForJob(task, args, kwargs, jobHandle, attempt, account, user, cluster):
+    """
+    Schedules the next check of a running job server job. On the first
+    check the job is registered for a completion event, which re-runs
+    the check right away, until then the job is polled with a backoff.
+    A check woken by the event that finds the job still running leaves
+    the polling to the existing chain rather than starting a second one.
+
+    Args:
+        task: the celery task that checks the job
+        args: the task's positional arguments
+        kwargs: the task's keyword arguments
+        jobHandle: the job server handle
+        attempt: the number of checks made so far, or WOKEN_ATTEMPT
+    """
+
+    if attempt == WOKEN_ATTEMPT:
+        return
+
+    if attempt == 0:
+
+        redisClient.set(jobWaitKey(jobHandle), json.dumps({
+            "task": task.name,
+            "args": args,
+            "kwargs": dict(kwargs, attempt=WOKEN_ATTEMPT)
+        }), ex=FINISHED_TTL)
+
+        try:
+            SHARK.post("/progress/notify", data={
+                "cluster": cluster,
+                "account": account,
+                "user": user,
+                "handle": jobHandle,
+                "channel": JOB_EVENTS_CHANNEL
+            })
+        except Exception:
+            logger.exception("Couldn't register for the completion of job '%s', polling for it instead" % jobHandle)
+
+    task.apply_async(args, dict(kwargs, attempt=attempt + 1), countdown=pollDelay(attempt))
+
+
+def jobFinished(jobHandle):
+    """
+    Returns:
+        False if the completion of a job has already been handled, e.g.
+        by a check triggered by its completion event
+    """
+
+    redisClient.delete(jobWaitKey(jobHandle))
+
+    return redisClient.set('jobdone:%s' % jobHandle, 1, nx=True, ex=FINISHED_TTL)
+
+
+def listenForJobEvents():
+    """
+    Runs the pending check of a job as soon as markcuban publishes its
+    completion. Meant to be run on a daemon thread by the lego service.
+    """
+
+    while True:
+
+        try:
+
+            pubsub = redisClient.pubsub()
+            pubsub.subscribe(JOB_EVENTS_CHANNEL)
+
+            for message in pubsub.listen():
+
+                if message['type'] != 'message':
+                    continue
+
+                jobHandle = json.loads(message['data'])['handle']
+
+                # every lego node hears the event, only one of them gets the check
+                pipe = redisClient.pipeline()
+                pipe.get(jobWaitKey(jobHandle))
+                pipe.delete(jobWaitKey(jobHandle))
+                waiting = pipe.execute()[0]
+
+                if waiting is not None:
+                    waiting = json.loads(waiting)
+                    celeryApp.tasks[waiting['task']].apply_async(waiting['args'], waiting['kwargs'])
+
+        except Exception:
+
+            logger.exception("Lost the job event subscription, resubscribing")
+            time.sleep(1)
+
+
 def workflowFinished(workflow, handle, options={}, error=None):
 
+    # steps running side by side can all try to finish the workflow,
+    # only the first one does
+    if not redisClient.set('workflow:%s:finished' % handle, 1, nx=True, ex=FINISHED_TTL):
+        return
+
+    releaseClusterSlots(workflow['account_id'], options.get('cluster'), handle, range(len(workflow['steps'])))
+    pipe = redisClient.pipeline()
+    for key in [stepsKey(handle, 'started'), stepsKey(handle, 'done'),
+                runKey(handle, 'definition'), runKey(handle, 'options')]:
+        pipe.expire(key, FINISHED_TTL)
+    pipe.execute()
+
     logger.info("OPTIONS: %s" % options)
     logger.info("Finished running workflow")
     makeHistory(workflow['account_id'], workflow['user_id'], "finish_workflow", workflow['id'], handle)
@@ -192,11 +469,8 @@ def workflowFinished(workflow, handle, options={}, error=None):
 
     if options.get("bootedCluster"):
         logger.info("Shutting down booted cluster '%s'" % options['cluster'])
-        requests.post(
-            "%s/cluster/%s/shutdown" % (
-                REDSHIRT_URL_FORMAT, 
-                options['cluster']
-            ),
+        REDSHIRT.post(
+            "/cluster/%s/shutdown" % options['cluster'],
             data={
                 "account": workflow['account_id'],
                 "user": workflow['user_id']
@@ -242,7 +516,19 @@ def workflowFinished(workflow, handle, options={}, error=None):
                 user.sendEmail(subject, body)
 
 
-def nextWorkflowStep(workflow, options, handle):
+def nextWorkflowStep(handle, finishedStep=None):
+    """
+    Records a finished step and starts every step whose dependencies
+    have all finished, up to the workflow and cluster limits
+
+    Args:
+        handle: the workflow handle
+        finishedStep: the index of the step that just finished, if any
+    """
+
+    workflow, options, _ = loadRun(handle)
+    if workflow is None:
+        return
 
     if isCancelled(handle):
         workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
@@ -254,39 +540,88 @@ def nextWorkflowStep(workflow, options, handle):
         cluster = workflow['cluster']
         
         if cluster['action'] == 'start':
-            startBootCluster.delay(workflow, cluster, options, handle)
+            startBootCluster.delay(handle)
             return
 
         elif cluster['action'] == 'pick':
             options['cluster'] = cluster['name']
+            setRunOptions(handle, cluster=cluster['name'])
+
+    account = workflow['account_id']
+    user = workflow['user_id']
+    cluster = options['cluster']
+    steps = workflow['steps']
 
-    options['stepsComplete'] += 1
-    setHandleInfo(handle, workflow['account_id'], workflow['user_id'], stepsComplete=options['stepsComplete'])
+    if finishedStep is not None:
+        releaseClusterSlots(account, cluster, handle, [finishedStep])
 
-    if len(workflow['steps']) == 0:
+    # record the step and read back a consistent view of the run
+    pipe = redisClient.pipeline()
+    if finishedStep is not None:
+        pipe.sadd(stepsKey(handle, 'done'), finishedStep)
+    pipe.smembers(stepsKey(handle, 'done'))
+    pipe.smembers(stepsKey(handle, 'started'))
+    done, started = pipe.execute()[-2:]
+
+    done = set([int(index) for index in done])
+    started = set([int(index) for index in started])
+
+    setHandleInfo(handle, account, user, stepsComplete=len(done))
+
+    if len(done) == len(steps):
 
         workflowFinished(workflow, handle, options)
+        return
 
-    else:
+    dependencies = getStepDependencies(steps)
+    running = len(started - done)
+    maxSteps = options.get('maxParallelSteps', MAX_WORKFLOW_STEPS)
+
+    for index, step in enumerate(steps):
+
+        if running >= maxSteps:
+            break
+
+        if index in started or not all([dependency in done for dependency in dependencies[index]]):
+            continue
+
+        if not claimClusterSlot(account, cluster, handle, index):
+            # steps that are still running will try again when they finish
+            if running == 0:
+                setHandleInfo(handle, account, user, message="Waiting for room on cluster '%s'" % cluster)
+                continueWorkflow.apply_async((handle,), countdown=CLUSTER_BUSY_RETRY)
+            break
 
-        step = workflow['steps'][0]
-        workflow['steps'] = workflow['steps'][1:]
+        # another task may have started this step in the meantime
+        if not redisClient.sadd(stepsKey(handle, 'started'), index):
+            releaseClusterSlots(account, cluster, handle, [index])
+            continue
 
-        setHandleInfo(handle, workflow['account_id'], workflow['user_id'], currentStep=step)
+        running += 1
 
-        stepType = step['type']
+        step = dict(step)
+        step['index'] = index
+
+        setHandleInfo(handle, account, user, currentStep=step)
 
         if step['type'] == "sql":
-            startRunQuery.delay(workflow, step, options, handle)
+            startRunQuery.delay(handle, index)
 
         elif step['type'] == "python":
-            startRunJob.delay(workflow, step, options, handle)
+            startRunJob.delay(handle, index)
 
         elif step['type'] in { "import", "export" }:
-            startRunDatajob.delay(workflow, step, options, handle)
+            startRunDatajob.delay(handle, index)
 
         else:
             workflowFinished(workflow, handle, options, error="Uknown job type %s" % step['type'])
+            return
+
+
+@celeryApp.task
+def continueWorkflow(handle):
+
+    nextWorkflowStep(handle)
 
 
 ###
@@ -296,7 +631,13 @@ def nextWorkflowStep(workflow, options, handle):
 MAX_BOOT_WAIT = 600
 
 @celeryApp.task
-def startBootCluster(workflow, cluster, options, handle):
+def startBootCluster(handle):
+
+    workflow, options, _ = loadRun(handle)
+    if workflow is None:
+        return
+
+    cluster = workflow['cluster']
 
     if isCancelled(handle):
         workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
@@ -311,7 +652,7 @@ def startBootCluster(workflow, cluster, options, handle):
     clusterName = cluster["name"]
 
     # begin the cluster launch
-    res = requests.post("%s/launch/cluster" % REDSHIRT_URL_FORMAT, data={
+    res = REDSHIRT.post("/launch/cluster", data={
         "account": account,
         "user": user,
         "workers": workers,
@@ -328,13 +669,18 @@ def startBootCluster(workflow, cluster, options, handle):
     start = time.time()
     maxWait = start + MAX_BOOT_WAIT
 
-    options['cluster'] = clusterName
-    options['bootedCluster'] = True
+    setRunOptions(handle, cluster=clusterName, bootedCluster=True)
 
-    waitBootCluster.delay(workflow, cluster, options, handle, maxWait)
+    waitBootCluster.delay(handle, maxWait)
 
 @celeryApp.task
-def waitBootCluster(workflow, cluster, options, handle, maxWait):
+def waitBootCluster(handle, maxWait):
+
+    workflow, options, _ = loadRun(handle)
+    if workflow is None:
+        return
+
+    cluster = workflow['cluster']
 
     if isCancelled(handle):
         workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
@@ -350,7 +696,7 @@ def waitBootCluster(workflow, cluster, options, handle, maxWait):
         }))
         return
 
-    res = requests.get("%s/cluster/%s" % (REDSHIRT_URL_FORMAT, clusterName), params={
+    res = REDSHIRT.get("/cluster/%s" % clusterName, params={
         "account": account,
         "user": user
     })
@@ -362,7 +708,7 @@ def waitBootCluster(workflow, cluster, options, handle, maxWait):
     if not res.json()["cluster"]["alive"]:
 
         setHandleInfo(handle, account, user, progress=res.json(), message="Cluster is booting up")
-        waitBootCluster.delay(workflow, cluster, options, handle, maxWait)
+        waitBootCluster.apply_async((handle, maxWait), countdown=BOOT_POLL_INTERVAL)
 
     else:
 
@@ -371,7 +717,7 @@ def waitBootCluster(workflow, cluster, options, handle, maxWait):
         makeHistory(workflow['account_id'], workflow['user_id'], "finish_boot_cluster", 
                     workflow['id'], handle, {'name': cluster['name']})
 
-        nextWorkflowStep(workflow, options, handle)
+        nextWorkflowStep(handle)
 
 
 
@@ -380,10 +726,14 @@ def waitBootCluster(workflow, cluster, options, handle, maxWait):
 ##
 
 @celeryApp.task
-def startRunQuery(workflow, step, options, infoHandle):
+def startRunQuery(infoHandle, stepIndex):
+
+    workflow, options, step = loadRun(infoHandle, stepIndex)
+    if workflow is None:
+        return
         
     if isCancelled(infoHandle):
-        workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
+        workflowFinished(workflow, infoHandle, options=options, error="Workflow has been cancelled")
         return
 
     historyData = {}
@@ -410,11 +760,8 @@ def startRunQuery(workflow, step, options, infoHandle):
     if queryId:
 
         # begin running the saved query
-        res = requests.post(
-            "%s/query/%s/run" % (
-                SHARK_URL_FORMAT,
-                queryId 
-            ),
+        res = SHARK.post(
+            "/query/%s/run" % queryId,
             data={
                 "cluster": cluster,
                 "account": account,
@@ -426,8 +773,8 @@ def startRunQuery(workflow, step, options, infoHandle):
     elif sql:
 
         # begin running the ad-hoc query
-        res = requests.post(
-            "%s/sql" % SHARK_URL_FORMAT,
+        res = SHARK.post(
+            "/sql",
             data={
                 "query": sql, 
                 "cluster": cluster,
@@ -450,13 +797,13 @@ def startRunQuery(workflow, step, options, infoHandle):
 
     queryHandle = res.json()["handle"]
 
-    waitRunQuery.delay(workflow, step, options, infoHandle, queryHandle)
+    waitRunQuery.delay(infoHandle, stepIndex, queryHandle)
 
 def cancelJob(handle, account, user, cluster):
 
     logging.info("Cancelling job with handle '%s'" % handle)
 
-    requests.post("%s/spark/job/async/cancel" % FLINT_URL_FORMAT, {
+    FLINT.post("/spark/job/async/cancel", {
         "cluster": cluster,
         "account": account,
         "user": user,
@@ -464,7 +811,11 @@ def cancelJob(handle, account, user, cluster):
     })
 
 @celeryApp.task
-def waitRunQuery(workflow, step, options, infoHandle, queryHandle):
+def waitRunQuery(infoHandle, stepIndex, queryHandle, attempt=0):
+
+    workflow, options, step = loadRun(infoHandle, stepIndex)
+    if workflow is None:
+        return
             
     account = workflow['account_id']
     user = workflow['user_id']
@@ -472,11 +823,11 @@ def waitRunQuery(workflow, step, options, infoHandle, queryHandle):
 
     if isCancelled(infoHandle):
         
-        workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
+        workflowFinished(workflow, infoHandle, options=options, error="Workflow has been cancelled")
         cancelJob(queryHandle, account, user, cluster)
         return
 
-    res = requests.get("%s/progress" % SHARK_URL_FORMAT, params={
+    res = SHARK.get("/progress", params={
         "cluster": cluster,
         "account": account,
         "user": user,
@@ -491,11 +842,12 @@ def waitRunQuery(workflow, step, options, infoHandle, queryHandle):
 
     if res.json()["running"]:
 
-        waitRunQuery.delay(workflow, step, options, infoHandle, queryHandle)
+        waitForJob(waitRunQuery, [infoHandle, stepIndex, queryHandle], {},
+                   queryHandle, attempt, account, user, cluster)
 
-    else:
+    elif jobFinished(queryHandle):
 
-        res = requests.get("%s/results" % SHARK_URL_FORMAT, params={
+        res = SHARK.get("/results", params={
             "account": account,
             "user": user,
             "handle": queryHandle
@@ -523,7 +875,7 @@ def waitRunQuery(workflow, step, options, infoHandle, queryHandle):
             workflowFinished(workflow, infoHandle, options=options, error=res.text)
             return
 
-        nextWorkflowStep(workflow, options, infoHandle)
+        nextWorkflowStep(infoHandle, finishedStep=stepIndex)
 
 
 
@@ -532,10 +884,14 @@ def waitRunQuery(workflow, step, options, infoHandle, queryHandle):
 ##
 
 @celeryApp.task
-def startRunJob(workflow, step, options, infoHandle):
+def startRunJob(infoHandle, stepIndex):
+
+    workflow, options, step = loadRun(infoHandle, stepIndex)
+    if workflow is None:
+        return
     
     if isCancelled(infoHandle):
-        workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
+        workflowFinished(workflow, infoHandle, options=options, error="Workflow has been cancelled")
         return
 
     makeHistory(workflow['account_id'], workflow['user_id'], "start_run_job", 
@@ -553,11 +909,8 @@ def startRunJob(workflow, step, options, infoHandle):
         }))
         return
 
-    res = requests.post(
-        "%s/job/%s/run" % (
-            FLINT_URL_FORMAT,
-            jobId 
-        ),
+    res = FLINT.post(
+        "/job/%s/run" % jobId,
         data={
             "cluster": cluster,
             "account": account,
@@ -574,7 +927,7 @@ def startRunJob(workflow, step, options, infoHandle):
 
     flintHandle = res.json()["handle"]
 
-    waitFlintHandle.delay(workflow, step, options, infoHandle, flintHandle)
+    waitFlintHandle.delay(infoHandle, stepIndex, flintHandle)
 
 
 
@@ -582,10 +935,15 @@ def startRunJob(workflow, step, options, infoHandle):
 # DATAJOB TASK
 ##
 
-def startRunDatajob(workflow, step, options, infoHandle):
+@celeryApp.task
+def startRunDatajob(infoHandle, stepIndex):
+
+    workflow, options, step = loadRun(infoHandle, stepIndex)
+    if workflow is None:
+        return
     
     if isCancelled(infoHandle):
-        workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
+        workflowFinished(workflow, infoHandle, options=options, error="Workflow has been cancelled")
         return
 
     makeHistory(workflow['account_id'], workflow['user_id'], "start_run_%s_job" % step['type'], 
@@ -604,11 +962,8 @@ def startRunDatajob(workflow, step, options, infoHandle):
         }))
         return
 
-    res = requests.post(
-        "%s/datajob/%s/run" % (
-            JAUNT_URL_FORMAT,
-            datajobId 
-        ),
+    res = JAUNT.post(
+        "/datajob/%s/run" % datajobId,
         data={
             "cluster": cluster,
             "account": account,
@@ -625,7 +980,7 @@ def startRunDatajob(workflow, step, options, infoHandle):
 
     flintHandle = res.json()["handle"]
 
-    waitFlintHandle.delay(workflow, step, options, infoHandle, flintHandle, jobType=jobType)
+    waitFlintHandle.delay(infoHandle, stepIndex, flintHandle, jobType=jobType)
 
 
 
@@ -634,21 +989,25 @@ def startRunDatajob(workflow, step, options, infoHandle):
 ##
 
 @celeryApp.task
-def waitFlintHandle(workflow, step, options, infoHandle, flintHandle, jobType=""):
+def waitFlintHandle(infoHandle, stepIndex, flintHandle, jobType="", attempt=0):
 
-    if isCancelled(infoHandle):
-        workflowFinished(workflow, handle, options=options, error="Workflow has been cancelled")
-        cancelJob(flintHandle, account, user, cluster)
+    workflow, options, step = loadRun(infoHandle, stepIndex)
+    if workflow is None:
         return
 
     account = workflow['account_id']
     user = workflow['user_id']
     cluster = options.get("cluster")
 
+    if isCancelled(infoHandle):
+        workflowFinished(workflow, infoHandle, options=options, error="Workflow has been cancelled")
+        cancelJob(flintHandle, account, user, cluster)
+        return
+
     if jobType and jobType[-1] != " ":
         jobType += " "
         
-    res = requests.get("%s/spark/job/async/progress" % FLINT_URL_FORMAT, params={
+    res = FLINT.get("/spark/job/async/progress", params={
         "cluster": cluster,
         "account": account,
         "user": user,
@@ -663,11 +1022,12 @@ def waitFlintHandle(workflow, step, options, infoHandle, flintHandle, jobType=""
 
     if res.json()["running"]:
 
-        waitFlintHandle.delay(workflow, step, options, infoHandle, flintHandle, jobType)
+        waitForJob(waitFlintHandle, [infoHandle, stepIndex, flintHandle], {"jobType": jobType},
+                   flintHandle, attempt, account, user, cluster)
 
-    else:
+    elif jobFinished(flintHandle):
 
-        res = requests.get("%s/spark/job/async/results" % FLINT_URL_FORMAT, params={
+        res = FLINT.get("/spark/job/async/results", params={
             "account": account,
             "user": user,
             "handle": flintHandle
@@ -691,4 +1051,4 @@ def waitFlintHandle(workflow, step, options, infoHandle, flintHandle, jobType=""
         message = "%s job has finished" % jobType.capitalize() if jobType else "Job has finished"
         setHandleInfo(infoHandle, account, user, progress=res.json(), message=message)
 
-        nextWorkflowStep(workflow, options, infoHandle)
+        nextWorkflowStep(infoHandle, finishedStep=stepIndex)
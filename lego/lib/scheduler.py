@@ -1,268 +1,360 @@
-##################
-# TODO
-# Right now, celery writes its scheduled task to a local celery beat file
-# but this is bad because it is not fault tolerant and will not scale in
-# a way that I like. In the future, celery beat should be backed by redis
-# with locks that use zk. This will allow a distributed scheduling setup.
-##################
+# Standard Library
+import calendar
+import datetime
+import logging
+import os
+import socket
+import time
+
+# Third Party
+import mixingboard
+from chassis.database import db_session
+from chassis.models import Workflow
+from sqlalchemy import or_
+
+# Local
+from runner import redisClient, runWorkflow
+
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# the workflow columns making up a schedule, in crontab order,
+# with the values each one allows
+CRON_FIELDS = [
+    ("schedule_minute", 0, 59),
+    ("schedule_hour", 0, 23),
+    ("schedule_day_of_month", 1, 31),
+    ("schedule_month", 1, 12),
+    ("schedule_day_of_week", 0, 7)
+]
+
+# days to search for a schedule's next fire time before deciding it
+# never fires (e.g. the 30th of February)
+MAX_SCHEDULE_DAYS = 4 * 366
+
+# the next fire time of every scheduled workflow by workflow id,
+# and the schedule each fire time was computed from
+SCHEDULE_KEY = "schedule:workflows"
+SCHEDULE_SPECS_KEY = "schedule:specs"
+
+# seconds between checks for due workflows, and between reloads
+# of the schedules from the database
+TICK_INTERVAL = 5
+SYNC_INTERVAL = 60
+
+# seconds to wait before running for leader again after an error
+ELECTION_RETRY = 10
+
+# moves a workflow to its next fire time, unless another scheduler
+# already did, so that a fire time is only ever claimed once
+#   KEYS: the schedule sorted set
+#   ARGV: the workflow id, the claimed fire time, the next fire time
+ADVANCE_SCHEDULE = redisClient.register_script("""
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    return 1
+end
+return 0
+""")
+
+
+def parseCronField(value, low, high):
+    """
+    Parses a single crontab field, e.g. '*', '5', '1-5', '*/15' or '0,30'
+
+    Args:
+        value: the field as written
+        low: the smallest allowed value
+        high: the largest allowed value
+    Returns:
+        the set of values the field matches
+    """
+
+    values = set()
+    for part in value.split(","):
+
+        rangePart, _, step = part.partition("/")
 
+        try:
+            step = int(step) if step else 1
+            if rangePart == "*":
+                start, end = low, high
+            elif "-" in rangePart:
+                start, end = [int(bound) for bound in rangePart.split("-", 1)]
+            else:
+                start = int(rangePart)
+                end = high if "/" in part else start
+        except ValueError:
+            raise ValueError("'%s' is not a valid schedule value" % part)
 
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError("'%s' is not a valid schedule value between %s and %s" % (part, low, high))
 
+        values.update(range(start, end + 1, step))
 
+    return values
 
 
-from __future__ import absolute_import
+def scheduleSpec(workflow):
+    """
+    Returns:
+        a workflow's schedule as a crontab line with unset fields as
+        '*', or None if the workflow is not scheduled
+    """
 
-import logging
+    values = [getattr(workflow, name) for name, _, _ in CRON_FIELDS]
+    if all([value is None or str(value).strip() == "" for value in values]):
+        return None
+
+    return " ".join(["*" if value is None or str(value).strip() == "" else str(value).strip()
+                     for value in values])
+
+
+def parseSchedule(spec):
+    """
+    Parses a crontab line. Times are in UTC, and like cron a day matches
+    either field when both the day of month and day of week are restricted.
+
+    Args:
+        spec: a crontab line as returned by scheduleSpec
+    Returns:
+        a schedule for nextFireTime
+    """
+
+    parts = spec.split()
+    if len(parts) != len(CRON_FIELDS):
+        raise ValueError("'%s' is not a valid schedule" % spec)
+
+    minutes, hours, daysOfMonth, months, daysOfWeek = [
+        parseCronField(part, low, high) for part, (_, low, high) in zip(parts, CRON_FIELDS)
+    ]
+
+    # cron accepts both 0 and 7 for sunday
+    if 7 in daysOfWeek:
+        daysOfWeek.add(0)
+
+    return {
+        "minutes": sorted(minutes),
+        "hours": sorted(hours),
+        "daysOfMonth": daysOfMonth,
+        "months": months,
+        "daysOfWeek": daysOfWeek,
+        "anyDayOfMonth": parts[2].startswith("*"),
+        "anyDayOfWeek": parts[4].startswith("*")
+    }
+
+
+def _dayMatches(schedule, day):
+
+    if day.month not in schedule["months"]:
+        return False
+
+    dayOfMonth = day.day in schedule["daysOfMonth"]
+    # python counts weekdays from monday, cron from sunday
+    dayOfWeek = (day.weekday() + 1) % 7 in schedule["daysOfWeek"]
 
-from multiprocessing.util import Finalize
+    if schedule["anyDayOfMonth"] or schedule["anyDayOfWeek"]:
+        return dayOfMonth and dayOfWeek
 
-from anyjson import loads, dumps
-from celery import current_app
-from celery import schedules
-from celery.beat import Scheduler, ScheduleEntry
-from celery.utils.encoding import safe_str, safe_repr
-from celery.utils.log import get_logger
-from celery.utils.timeutils import is_naive
+    return dayOfMonth or dayOfWeek
 
-from django.db import transaction
-from django.core.exceptions import ObjectDoesNotExist
 
-from .db import commit_on_success
-from .models import (PeriodicTask, PeriodicTasks,
-                     CrontabSchedule, IntervalSchedule)
-from .utils import DATABASE_ERRORS, make_aware
+def nextFireTime(schedule, after):
+    """
+    Finds the first minute a schedule fires after a given time
 
-# This scheduler must wake up more frequently than the
-# regular of 5 minutes because it needs to take external
-# changes to the schedule into account.
-DEFAULT_MAX_INTERVAL = 5  # seconds
+    Args:
+        schedule: a schedule as returned by parseSchedule
+        after: a unix timestamp
+    Returns:
+        the next fire time as a unix timestamp
+    """
 
-ADD_ENTRY_ERROR = """\
-Couldn't add entry %r to database schedule: %r. Contents: %r
-"""
+    start = datetime.datetime.utcfromtimestamp(int(after)).replace(second=0) + datetime.timedelta(minutes=1)
 
-logger = get_logger(__name__)
-debug, info, error = logger.debug, logger.info, logger.error
+    day = start.date()
+    for _ in range(MAX_SCHEDULE_DAYS):
 
+        if _dayMatches(schedule, day):
 
-class RedisEntry(ScheduleEntry):
-    model_schedules = ((schedules.crontab, CrontabSchedule, 'crontab'),
-                       (schedules.schedule, IntervalSchedule, 'interval'))
-    save_fields = ['last_run_at', 'total_run_count', 'no_changes']
+            for hour in schedule["hours"]:
+                for minute in schedule["minutes"]:
+                    fireTime = datetime.datetime(day.year, day.month, day.day, hour, minute)
+                    if fireTime >= start:
+                        return calendar.timegm(fireTime.utctimetuple())
+
+        day += datetime.timedelta(days=1)
+
+    raise ValueError("This schedule never runs")
+
+
+def getSchedule(workflow):
+    """
+    Returns:
+        a workflow's parsed schedule, or None if it is not scheduled
+    """
+
+    spec = scheduleSpec(workflow)
+    if spec is None:
+        return None
+
+    schedule = parseSchedule(spec)
+    # make sure it fires at all
+    nextFireTime(schedule, time.time())
+
+    return schedule
+
+
+def unscheduleWorkflow(workflowId):
+
+    pipe = redisClient.pipeline()
+    pipe.zrem(SCHEDULE_KEY, workflowId)
+    pipe.hdel(SCHEDULE_SPECS_KEY, workflowId)
+    pipe.execute()
+
+
+def syncSchedules():
+    """
+    Brings the fire times in redis up to date with the schedules in
+    the database. Workflows new to the schedule fire next after their
+    last run, so runs missed while the schedule was lost still happen,
+    and changed schedules fire next after the current time.
+    """
+
+    workflows = Workflow.query.filter(or_(*[getattr(Workflow, name) != None
+                                            for name, _, _ in CRON_FIELDS])).all()
+    storedSpecs = redisClient.hgetall(SCHEDULE_SPECS_KEY)
+
+    now = time.time()
+    specs = {}
+    pipe = redisClient.pipeline()
+    for workflow in workflows:
+
+        workflowId = str(workflow.id)
+        spec = scheduleSpec(workflow)
+        if spec is None:
+            continue
+
+        specs[workflowId] = spec
+        if storedSpecs.get(workflowId) == spec:
+            continue
 
-    def __init__(self, model):
-        self.app = current_app._get_current_object()
-        self.name = model.name
-        self.task = model.task
         try:
-            self.schedule = model.schedule
-        except model.DoesNotExist:
-            logger.error('Schedule was removed from database')
-            logger.warning('Disabling %s', self.name)
-            self._disable(model)
+            schedule = parseSchedule(spec)
+            after = now
+            if workflowId not in storedSpecs and workflow.last_run is not None:
+                after = calendar.timegm(workflow.last_run.utctimetuple())
+            fireTime = nextFireTime(schedule, after)
+        except ValueError as e:
+            logger.warning("Not scheduling workflow %s with schedule '%s': %s" % (workflowId, spec, e))
+            continue
+
+        logger.info("Scheduling workflow %s with schedule '%s'" % (workflowId, spec))
+        pipe.zadd(SCHEDULE_KEY, fireTime, workflowId)
+        pipe.hset(SCHEDULE_SPECS_KEY, workflowId, spec)
+
+    for workflowId in set(storedSpecs) - set(specs):
+        logger.info("Unscheduling workflow %s" % workflowId)
+        pipe.zrem(SCHEDULE_KEY, workflowId)
+        pipe.hdel(SCHEDULE_SPECS_KEY, workflowId)
+
+    pipe.execute()
+
+
+def fireDueWorkflows():
+    """
+    Runs every workflow whose fire time has passed. A workflow that
+    missed several fire times, e.g. while no scheduler was running,
+    runs once to catch up and then fires on schedule again.
+    """
+
+    now = time.time()
+    for workflowId, fireTime in redisClient.zrangebyscore(SCHEDULE_KEY, '-inf', int(now), withscores=True):
+
+        workflow = Workflow.query.filter(Workflow.id == int(workflowId)).first()
+
         try:
-            self.args = loads(model.args or '[]')
-            self.kwargs = loads(model.kwargs or '{}')
+            schedule = getSchedule(workflow) if workflow is not None else None
         except ValueError:
-            logging.error('Failed to serialize arguments for %s.', self.name,
-                          exc_info=1)
-            logging.warning('Disabling %s', self.name)
-            self._disable(model)
-
-        self.options = {'queue': model.queue,
-                        'exchange': model.exchange,
-                        'routing_key': model.routing_key,
-                        'expires': model.expires}
-        self.total_run_count = model.total_run_count
-        self.model = model
-
-        if not model.last_run_at:
-            model.last_run_at = self._default_now()
-        orig = self.last_run_at = model.last_run_at
-        if not is_naive(self.last_run_at):
-            self.last_run_at = self.last_run_at.replace(tzinfo=None)
-        assert orig.hour == self.last_run_at.hour  # timezone sanity
-
-    def _disable(self, model):
-        model.no_changes = True
-        model.enabled = False
-        model.save()
-
-    def is_due(self):
-        if not self.model.enabled:
-            return False, 5.0   # 5 second delay for re-enable.
-        return self.schedule.is_due(self.last_run_at)
-
-    def _default_now(self):
-        return self.app.now()
-
-    def __next__(self):
-        self.model.last_run_at = self.app.now()
-        self.model.total_run_count += 1
-        self.model.no_changes = True
-        return self.__class__(self.model)
-    next = __next__  # for 2to3
-
-    def save(self):
-        # Object may not be synchronized, so only
-        # change the fields we care about.
-        obj = self.model._default_manager.get(pk=self.model.pk)
-        for field in self.save_fields:
-            setattr(obj, field, getattr(self.model, field))
-        obj.last_run_at = make_aware(obj.last_run_at)
-        obj.save()
-
-    @classmethod
-    def to_model_schedule(cls, schedule):
-        for schedule_type, model_type, model_field in cls.model_schedules:
-            schedule = schedules.maybe_schedule(schedule)
-            if isinstance(schedule, schedule_type):
-                model_schedule = model_type.from_schedule(schedule)
-                model_schedule.save()
-                return model_schedule, model_field
-        raise ValueError(
-            'Cannot convert schedule type {0!r} to model'.format(schedule))
-
-    @classmethod
-    def from_entry(cls, name, skip_fields=('relative', 'options'), **entry):
-        options = entry.get('options') or {}
-        fields = dict(entry)
-        for skip_field in skip_fields:
-            fields.pop(skip_field, None)
-        schedule = fields.pop('schedule')
-        model_schedule, model_field = cls.to_model_schedule(schedule)
-        fields[model_field] = model_schedule
-        fields['args'] = dumps(fields.get('args') or [])
-        fields['kwargs'] = dumps(fields.get('kwargs') or {})
-        fields['queue'] = options.get('queue')
-        fields['exchange'] = options.get('exchange')
-        fields['routing_key'] = options.get('routing_key')
-        return cls(PeriodicTask._default_manager.update_or_create(
-            name=name, defaults=fields,
-        ))
-
-    def __repr__(self):
-        return '<ModelEntry: {0} {1}(*{2}, **{3}) {{4}}>'.format(
-            safe_str(self.name), self.task, safe_repr(self.args),
-            safe_repr(self.kwargs), self.schedule,
-        )
-
-
-class DatabaseScheduler(Scheduler):
-    Entry = ModelEntry
-    Model = PeriodicTask
-    Changes = PeriodicTasks
-    _schedule = None
-    _last_timestamp = None
-    _initial_read = False
-
-    def __init__(self, *args, **kwargs):
-        self._dirty = set()
-        self._finalize = Finalize(self, self.sync, exitpriority=5)
-        Scheduler.__init__(self, *args, **kwargs)
-        self.max_interval = (
-            kwargs.get('max_interval') or
-            self.app.conf.CELERYBEAT_MAX_LOOP_INTERVAL or
-            DEFAULT_MAX_INTERVAL)
-
-    def setup_schedule(self):
-        self.install_default_entries(self.schedule)
-        self.update_from_dict(self.app.conf.CELERYBEAT_SCHEDULE)
-
-    def all_as_schedule(self):
-        debug('DatabaseScheduler: Fetching database schedule')
-        s = {}
-        for model in self.Model.objects.enabled():
-            try:
-                s[model.name] = self.Entry(model)
-            except ValueError:
-                pass
-        return s
-
-    def schedule_changed(self):
+            schedule = None
+
+        if schedule is None:
+            unscheduleWorkflow(workflowId)
+            continue
+
+        # the fire time is claimed before the run starts, so a scheduler
+        # dying in between skips a run rather than running it twice
+        if not ADVANCE_SCHEDULE(keys=[SCHEDULE_KEY], args=[workflowId, int(fireTime), nextFireTime(schedule, now)]):
+            continue
+
+        if now - fireTime > SYNC_INTERVAL:
+            logger.info("Catching up on workflow %s, scheduled for %s" % (
+                workflowId, datetime.datetime.utcfromtimestamp(fireTime)))
+
         try:
-            # If MySQL is running with transaction isolation level
-            # REPEATABLE-READ (default), then we won't see changes done by
-            # other transactions until the current transaction is
-            # committed (Issue #41).
-            try:
-                transaction.commit()
-            except transaction.TransactionManagementError:
-                pass  # not in transaction management.
-
-            last, ts = self._last_timestamp, self.Changes.last_change()
-        except DATABASE_ERRORS as exc:
-            error('Database gave error: %r', exc, exc_info=1)
-            return False
+
+            workflow.last_run = datetime.datetime.utcnow()
+            db_session.add(workflow)
+            db_session.commit()
+
+            handle = runWorkflow(workflow)
+            logger.info("Started scheduled workflow %s as '%s'" % (workflowId, handle))
+
+        except Exception:
+
+            db_session.rollback()
+            logger.exception("Error starting scheduled workflow %s" % workflowId)
+
+
+def leadScheduler():
+    """
+    Fires scheduled workflows for as long as this process is the
+    leader and stays connected to zookeeper
+    """
+
+    logger.info("Became the workflow scheduler")
+
+    lastSync = 0
+    while mixingboard.zk.connected:
+
         try:
-            if ts and ts > (last if last else ts):
-                return True
+
+            if time.time() - lastSync >= SYNC_INTERVAL:
+                syncSchedules()
+                lastSync = time.time()
+
+            fireDueWorkflows()
+
+        except Exception:
+
+            logger.exception("Error running scheduled workflows")
+
         finally:
-            self._last_timestamp = ts
-        return False
 
-    def reserve(self, entry):
-        new_entry = Scheduler.reserve(self, entry)
-        # Need to store entry by name, because the entry may change
-        # in the mean time.
-        self._dirty.add(new_entry.name)
-        return new_entry
+            # end the transaction so the next pass sees schedule changes
+            db_session.remove()
+
+        time.sleep(TICK_INTERVAL)
+
+    logger.info("Lost connection to zookeeper, giving up the workflow scheduler")
+
+
+def runScheduler():
+    """
+    Runs for leader of the lego schedulers forever, so that exactly
+    one lego instance fires scheduled workflows at a time
+    """
+
+    election = mixingboard.leaderElection("lego-scheduler", "%s:%s" % (socket.gethostname(), os.getpid()))
+
+    while True:
 
-    def sync(self):
-        info('Writing entries...')
-        _tried = set()
         try:
-            with commit_on_success():
-                while self._dirty:
-                    try:
-                        name = self._dirty.pop()
-                        _tried.add(name)
-                        self.schedule[name].save()
-                    except (KeyError, ObjectDoesNotExist):
-                        pass
-        except DATABASE_ERRORS as exc:
-            # retry later
-            self._dirty |= _tried
-            error('Database error while sync: %r', exc, exc_info=1)
-
-    def update_from_dict(self, dict_):
-        s = {}
-        for name, entry in dict_.items():
-            try:
-                s[name] = self.Entry.from_entry(name, **entry)
-            except Exception as exc:
-                error(ADD_ENTRY_ERROR, name, exc, entry)
-        self.schedule.update(s)
-
-    def install_default_entries(self, data):
-        entries = {}
-        if self.app.conf.CELERY_TASK_RESULT_EXPIRES:
-            entries.setdefault(
-                'celery.backend_cleanup', {
-                    'task': 'celery.backend_cleanup',
-                    'schedule': schedules.crontab('0', '4', '*'),
-                    'options': {'expires': 12 * 3600},
-                },
-            )
-        self.update_from_dict(entries)
-
-    @property
-    def schedule(self):
-        update = False
-        if not self._initial_read:
-            debug('DatabaseScheduler: intial read')
-            update = True
-            self._initial_read = True
-        elif self.schedule_changed():
-            info('DatabaseScheduler: Schedule changed.')
-            update = True
-
-        if update:
-            self.sync()
-            self._schedule = self.all_as_schedule()
-            if logger.isEnabledFor(logging.DEBUG):
-                debug('Current schedule:\n%s', '\n'.join(
-                    repr(entry) for entry in self._schedule.itervalues()),
-                )
-        return self._schedule
+            election.run(leadScheduler)
+        except Exception:
+            logger.exception("Error running for workflow scheduler")
+
+        time.sleep(ELECTION_RETRY)
@@ -6,24 +6,29 @@ import json
 import logging
 import os
 import subprocess
+from threading import Thread
 
 # Third Party
 import requests
 import mixingboard
+from chassis import httpclient
 from chassis.database import db_session
 from chassis.models import Workflow
 from flask import Flask, jsonify, request
 
 # Local
 from lib.runner import runWorkflow, getHandleInfo, makeHistory, \
-    getRunningWorkflows, cancelHandle
+    getRunningWorkflows, cancelHandle, listenForJobEvents
+from lib.scheduler import runScheduler, getSchedule
 
 # parse args
 argParser = argparse.ArgumentParser(description='Run the Quarry server.')
 argParser.add_argument('-d', '--debug', action='store_true', help='Turn on debug mode')
 argParser.add_argument('-p', '--port', type=int, default=3591, help='Set the port')
 argParser.add_argument('-H', '--host', type=str, default='127.0.0.1', help='Set the port')
+httpclient.addArguments(argParser)
 args, _ = argParser.parse_known_args()
+httpclient.configureFromArgs(args)
 
 # put args in sensible all caps variables
 DEBUG = args.debug
@@ -36,54 +41,6 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-# setup shark configurations
-global SHARK_URL_FORMAT
-SHARK_URL_FORMAT = None
-def setSharkURLFormat(sharkServers):
-    global SHARK_URL_FORMAT
-    shark = sharkServers[0]
-    SHARK_URL_FORMAT = "http://%s:%s/shark/" % (shark["host"], shark["port"])
-    logging.info("GOT SHARK SERVICE: %s" % SHARK_URL_FORMAT)
-
-mixingboard.discoverService("shark",setSharkURLFormat) 
-
-
-# setup jaunt configurations
-global JAUNT_URL_FORMAT
-JAUNT_URL_FORMAT = None
-def setJauntURLFormat(jauntServers):
-    global JAUNT_URL_FORMAT
-    jauntServer = jauntServers[0]
-    JAUNT_URL_FORMAT = "http://%s:%s/jaunt/" % (jauntServer["host"], jauntServer["port"])
-    logging.info("GOT JAUNT SERVICE: %s" % JAUNT_URL_FORMAT)
-
-mixingboard.discoverService("jaunt",setJauntURLFormat) 
-
-
-# setup redshirt configurations
-global REDSHIRT_URL_FORMAT
-REDSHIRT_URL_FORMAT = None
-def setSharkURLFormat(redShirtServers):
-    global REDSHIRT_URL_FORMAT
-    redShirt = redShirtServers[0]
-    REDSHIRT_URL_FORMAT = "http://%s:%s/redshirt/" % (redShirt["host"], redShirt["port"])
-    logging.info("GOT REDSHIRT SERVICE: %s" % REDSHIRT_URL_FORMAT)
-
-mixingboard.discoverService("redshirt",setSharkURLFormat) 
-
-
-# setup flint configurations
-global FLINT_URL_FORMAT
-FLINT_URL_FORMAT = None
-def setFlintURLFormat(flintServers):
-    global FLINT_URL_FORMAT
-    flint = flintServers[0]
-    FLINT_URL_FORMAT = "http://%s:%s/flint/" % (flint["host"], flint["port"])
-    logging.info("GOT FLINT SERVICE: %s" % FLINT_URL_FORMAT)
-
-mixingboard.discoverService("flint",setFlintURLFormat) 
-
-
 # create flask app
 app = Flask(__name__, static_url_path='/static', static_folder='./static')
 
@@ -237,6 +194,10 @@ def edit_workflow(workflowId):
             workflow.schedule_month = schedule_month or None
         if schedule_day_of_week != -1:
             workflow.schedule_day_of_week = schedule_day_of_week or None
+        try:
+            getSchedule(workflow)
+        except ValueError as e:
+            errors['schedule'] = e.message
 
         if len(errors) > 0:
             return jsonify({
@@ -409,5 +370,13 @@ def run_workflow(workflowId):
 
 if __name__ == "__main__":
 
+    jobEventListener = Thread(target=listenForJobEvents)
+    jobEventListener.daemon = True
+    jobEventListener.start()
+
+    scheduler = Thread(target=runScheduler)
+    scheduler.daemon = True
+    scheduler.start()
+
     mixingboard.exposeService("lego", port=PORT)
     app.run(debug=DEBUG, port=PORT, host=HOST, threaded=True)
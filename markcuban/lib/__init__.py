@@ -1,2 +1,4 @@
 from cursor import Cursor
 from lru import LRU
+from progress import ProgressHub
+from ttlcache import TTLCache
@@ -0,0 +1,142 @@
+# Standard Library
+import struct
+
+# Third Party
+
+# Local
+
+
+# A page is laid out little endian as:
+#
+#   magic 'QCP1', uint32 row count, uint16 column count
+#   per column: uint8 type code, uint16 name length, utf-8 name
+#   per column: a null bitmap of ceil(rows/8) bytes (bit set = null)
+#               followed by the column values
+#
+# int64 and float64 columns store 8 bytes per row, boolean columns
+# store 1 byte per row, and string columns store rows+1 uint32 offsets
+# followed by the concatenated utf-8 values. Null cells hold a zero value.
+#
+# Only \N cells are null. A column with a cell that doesn't parse as
+# its schema type is sent as a string column for that page, so a
+# schema that doesn't match the query never loses values. Decimals
+# are sent as strings since float64 can't hold them exactly.
+
+MAGIC = "QCP1"
+MIMETYPE = "application/x-quarry-columnar"
+
+TYPE_STRING = 0
+TYPE_INT64 = 1
+TYPE_FLOAT64 = 2
+TYPE_BOOLEAN = 3
+
+HIVE_TYPES = {
+    "tinyint": TYPE_INT64,
+    "smallint": TYPE_INT64,
+    "int": TYPE_INT64,
+    "bigint": TYPE_INT64,
+    "float": TYPE_FLOAT64,
+    "double": TYPE_FLOAT64,
+    "boolean": TYPE_BOOLEAN
+}
+
+# hive writes NULL cells as \N in text output
+NULL_VALUE = "\\N"
+
+
+def typeCode(hiveType):
+    """
+    Maps a hive column type onto a page column type
+
+    Args:
+        hiveType: a type as reported by DESC FORMATTED, e.g. 'bigint'
+    Returns:
+        a page type code
+    """
+
+    return HIVE_TYPES.get(hiveType.split("(")[0].strip().lower(), TYPE_STRING)
+
+
+def _parse(value, code):
+
+    if code == TYPE_INT64:
+        value = int(value)
+        if not -2**63 <= value < 2**63:
+            raise ValueError("%s does not fit in an int64" % value)
+        return value
+    elif code == TYPE_FLOAT64:
+        return float(value)
+    elif code == TYPE_BOOLEAN:
+        if value.lower() not in ("true", "false"):
+            raise ValueError("%s is not a boolean" % value)
+        return value.lower() == "true"
+
+    return value
+
+
+def _encodeColumn(values, code):
+    """
+    Returns:
+        the page type code of the column, TYPE_STRING if any
+        value doesn't parse as the requested type
+        the encoded null bitmap and values
+    """
+
+    nulls = bytearray((len(values) + 7) / 8)
+    parsed = []
+    for i, value in enumerate(values):
+        if value is None or value == NULL_VALUE:
+            nulls[i / 8] |= 1 << (i % 8)
+            value = None
+        else:
+            try:
+                value = _parse(value, code)
+            except ValueError:
+                return _encodeColumn(values, TYPE_STRING)
+        parsed.append(value)
+
+    if code == TYPE_INT64:
+        body = struct.pack("<%sq" % len(parsed), *[value or 0 for value in parsed])
+    elif code == TYPE_FLOAT64:
+        body = struct.pack("<%sd" % len(parsed), *[value or 0.0 for value in parsed])
+    elif code == TYPE_BOOLEAN:
+        body = struct.pack("<%sB" % len(parsed), *[1 if value else 0 for value in parsed])
+    else:
+        offsets = [0]
+        for value in parsed:
+            offsets.append(offsets[-1] + len(value or ""))
+        body = struct.pack("<%sI" % len(offsets), *offsets) + \
+               "".join([value or "" for value in parsed])
+
+    return code, str(nulls) + body
+
+
+def encodePage(rows, columns=None):
+    """
+    Encodes a page of tab separated rows as typed column buffers
+
+    Args:
+        rows: a list of rows, each a list of strings
+        columns: a list of {"name": ..., "type": ...} dictionaries as
+            returned by processFormattedTableDescription. Without a schema
+            every column is encoded as a string named _c0, _c1, ...
+    Returns:
+        the encoded page as a string
+    """
+
+    if columns is None:
+        numCols = max([len(row) for row in rows] or [0])
+        columns = [{"name": "_c%s" % i, "type": "string"} for i in range(numCols)]
+
+    header = [MAGIC, struct.pack("<IH", len(rows), len(columns))]
+    body = []
+    for i, column in enumerate(columns):
+
+        values = [row[i] if i < len(row) else None for row in rows]
+        code, data = _encodeColumn(values, typeCode(column["type"]))
+
+        name = column["name"].encode("utf-8")
+        header.append(struct.pack("<BH", code, len(name)) + name)
+        body.append(data)
+
+    return "".join(header + body)
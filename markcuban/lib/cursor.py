@@ -1,8 +1,12 @@
 # Standard Library
+import json
 import logging
+import sys
+import time
+from Queue import Queue, Full
+from threading import Lock, Thread
 
 # Third Party
-from boto.exception import S3ResponseError
 from chassis.aws import getS3Conn
 from chassis.util import makeHandle
 from memoized_property import memoized_property
@@ -10,26 +14,69 @@ from memoized_property import memoized_property
 # Local 
 import mixingboard
 
+
+logger = logging.getLogger(__name__)
+
+
 class Cursor:
 
-    CHUNK_SIZE = 1024*1024 # Download 1 MB at a time
+    MIN_CHUNK_SIZE = 64*1024 # Start with 64 KB reads for quick previews
+    MAX_CHUNK_SIZE = 16*1024*1024
+    FAST_CHUNK_SECONDS = 0.5 # Grow the chunk size while reads finish faster than this
     DOWNLOAD_EXPIRES = 60*60*24*31
+    PREFETCH_IDLE_SECONDS = 60 # Stop reading ahead for cursors that haven't been read from in this long
 
-    def __init__(self, iamUsername, accessKeyId, accessKeySecret, region, queryHandle):
+    def __init__(self, iamUsername, accessKeyId, accessKeySecret, region, queryHandle,
+                 prefetchChunks=0, maxChunkSize=MAX_CHUNK_SIZE, handle=None, listing=None, bucket=None):
         
         self.iamUsername = iamUsername
         self.accessKeyId = accessKeyId
         self.accessKeySecret = accessKeySecret
         self.region = region
         self.queryHandle = queryHandle
-        self.handle = makeHandle()
+        self.handle = handle or makeHandle()
+        self.listing = listing
+        self.sharedBucket = bucket
+        # bumped every time the cursor's position is checkpointed
+        self.version = 0
+
+        # the result schema, if known, as a list of {"name", "type"} dicts
+        self.columns = None
 
-        self.data = ""
-        self.filesLeft = self.queryFiles[1:]
-        self.currentFile = self.queryFiles[0]
+        # carry-over bytes of a row that spans two chunks, reused
+        # between chunks rather than re-concatenated
+        self.data = bytearray()
+        # rows split out of the last chunk that haven't been fetched yet
+        self.rows = []
+        self.rowPos = 0
+        self.rowBytes = 0
+        self.exhausted = False
+        # the file and offset of the next chunk to be consumed
+        self.fileIndex = 0
         self.currentFilePosition = 0
-        self.needsData = True
-        self.curPos = 0
+        # the file and offset of the first buffered row and of the
+        # carry-over bytes, which is where a checkpoint resumes from
+        self.rowsStart = (0, 0)
+        self.dataStart = (0, 0)
+
+        # read-ahead state, the worker is only started on the first read
+        # and stops once the cursor sits unread, resuming where it left off
+        self.prefetchChunks = prefetchChunks
+        self.prefetchQueue = Queue(maxsize=max(prefetchChunks, 1))
+        self.prefetchThread = None
+        self.prefetchLock = Lock()
+        self.prefetchFrom = None
+        self.lastRead = time.time()
+        self.closed = False
+
+        # adaptive range sizing and throughput accounting
+        self.chunkSize = min(self.MIN_CHUNK_SIZE, maxChunkSize)
+        self.maxChunkSize = maxChunkSize
+        self.chunks = 0
+        self.bytesRead = 0
+        self.readSeconds = 0.0
+        self.rowsSplit = 0
+        self.bytesSplit = 0
 
     @memoized_property
     def prefix(self):
@@ -44,65 +91,390 @@ class Cursor:
 
     @memoized_property
     def bucket(self):
+        if self.sharedBucket is not None:
+            return self.sharedBucket
         return self.s3Conn.get_bucket(mixingboard.getConf("s3_bucket"), validate=False)
 
+    @memoized_property
+    def queryListing(self):
+        if self.listing is not None:
+            return self.listing
+        return [(key.key, key.size) for key in self.bucket.list(prefix=self.prefix)]
+
     @memoized_property 
     def queryFiles(self):
-        return [key.key for key in self.bucket.list(prefix=self.prefix)]
+        return [name for name, _ in self.queryListing]
+
+    @memoized_property
+    def querySizes(self):
+        return [size for _, size in self.queryListing]
 
     def queryFilesDownload(self):
-        return [key.generate_url(3600, method="GET") for key in self.bucket.list(prefix=self.prefix)]
+        return [self.bucket.new_key(name).generate_url(3600, method="GET") for name in self.queryFiles]
 
-    def getMoreData(self):
+    def advance(self, start, numBytes):
+        """
+        Moves a position forward through the result files as
+        if they were a single stream
+
+        Args:
+            start: a (fileIndex, offset) tuple
+            numBytes: the number of bytes to move forward
+        Returns:
+            the new (fileIndex, offset) tuple
+        """
+
+        fileIndex, position = start
+        position += numBytes
+        while fileIndex < len(self.querySizes) and position >= self.querySizes[fileIndex]:
+            position -= self.querySizes[fileIndex]
+            fileIndex += 1
+
+        return fileIndex, position
+
+    def nextRowPosition(self):
+        """
+        Returns:
+            the (fileIndex, offset) of the first row that hasn't been fetched
+        """
+
+        if self.rowPos >= len(self.rows):
+            return self.dataStart
+
+        # every fetched row was followed by a newline
+        consumed = sum([len(row) + sum([len(field) for field in row]) for row in self.rows[:self.rowPos]])
+
+        return self.advance(self.rowsStart, consumed)
+
+    def getState(self, withListing=True):
+        """
+        Captures the position of this cursor so that it can be resumed
+        elsewhere. Only the offset of the first unfetched row is kept,
+        a resumed cursor reads again from there.
+
+        Args:
+            withListing: whether to include the parts that never change,
+                which only have to be saved once
+        Returns:
+            a dictionary of strings
+        """
+
+        fileIndex, position = self.nextRowPosition()
+
+        state = {
+            "fileIndex": str(fileIndex),
+            "position": str(position),
+            "chunkSize": str(self.chunkSize),
+            "version": str(self.version)
+        }
+
+        if withListing:
+            state.update({
+                "queryHandle": self.queryHandle,
+                "listing": json.dumps(self.queryListing),
+                "columns": json.dumps(self.columns)
+            })
+
+        return state
+
+    def setState(self, state):
+        """
+        Restores a position captured by getState
+
+        Args:
+            state: a dictionary returned by getState
+        """
+
+        self.listing = [tuple(entry) for entry in json.loads(state["listing"])]
+        self.columns = json.loads(state["columns"])
+        self.fileIndex = int(state["fileIndex"])
+        self.currentFilePosition = int(state["position"])
+        self.rowsStart = self.dataStart = (self.fileIndex, self.currentFilePosition)
+        self.chunkSize = min(int(state["chunkSize"]), self.maxChunkSize)
+        self.exhausted = False
+        self.rows = []
+        self.rowPos = 0
+        self.rowBytes = 0
+        self.data = bytearray()
+        self.version = int(state["version"])
+
+    def memoryUsage(self):
+        """
+        Approximates the memory held by this cursor, which is
+        dominated by its row buffer and the list of result files
+
+        Returns:
+            the size of the cursor in bytes
+        """
+
+        return sys.getsizeof(self.data) + self.rowBytes + \
+               self.prefetchQueue.qsize()*self.chunkSize + \
+               sum(sys.getsizeof(queryFile) for queryFile in self.queryFiles)
+
+    def nextRange(self, fileIndex, position):
+        """
+        Computes the byte range of the next chunk from the known
+        sizes of the result files
+
+        Args:
+            fileIndex: the index of the file being read
+            position: the offset to read from in that file
+        Returns:
+            a (fileIndex, start, end) tuple with an exclusive end, or
+            None if there is nothing left to read
+        """
+
+        while fileIndex < len(self.queryFiles):
+
+            size = self.querySizes[fileIndex]
+            if position < size:
+                return fileIndex, position, min(position + self.chunkSize, size)
+
+            fileIndex += 1
+            position = 0
+
+        return None
+
+    def downloadRange(self, fileIndex, start, end):
+
+        startTime = time.time()
+
+        key = self.bucket.get_key(self.queryFiles[fileIndex], validate=False)
+        data = key.get_contents_as_string(
+            headers={
+                "Range": "bytes=%s-%s" % (start, end-1)
+            }
+        )
+
+        self.recordChunk(len(data), time.time() - startTime)
+
+        return data
+
+    def recordChunk(self, numBytes, seconds):
+        """
+        Records a finished range read and grows the chunk size while
+        reads are fast enough that request overhead dominates
+
+        Args:
+            numBytes: the number of bytes read
+            seconds: how long the read took
+        """
+
+        self.chunks += 1
+        self.bytesRead += numBytes
+        self.readSeconds += seconds
+
+        # only grow once a read actually filled the current chunk size
+        if numBytes >= self.chunkSize and seconds < self.FAST_CHUNK_SECONDS:
+            self.chunkSize = min(self.chunkSize*2, self.maxChunkSize)
+
+    def requestRows(self, numRows):
+        """
+        Grows the chunk size so that the next read can satisfy
+        the given number of rows, based on the average row size seen so far
+
+        Args:
+            numRows: the number of rows the caller is waiting for
+        """
+
+        if self.rowsSplit == 0:
+            return
 
-        while True:
+        wantedBytes = numRows * self.bytesSplit / self.rowsSplit
+        self.chunkSize = max(self.chunkSize, min(wantedBytes, self.maxChunkSize))
+
+    def stats(self):
+        """
+        Returns:
+            a dictionary describing the read throughput of this cursor
+        """
+
+        return {
+            "chunks": self.chunks,
+            "chunkSize": self.chunkSize,
+            "bytesRead": self.bytesRead,
+            "bytesPerSecond": self.bytesRead / self.readSeconds if self.readSeconds else 0
+        }
+
+    def prefetch(self):
+        """
+        Runs in a background thread, keeping the next few chunks
+        downloaded ahead of the reader
+        """
+
+        fileIndex, position = self.prefetchFrom or (self.fileIndex, self.currentFilePosition)
+
+        try:
+
+            while not self.closed:
+
+                nextRange = self.nextRange(fileIndex, position)
+                if nextRange is None:
+                    self.putPrefetched(None)
+                    return
+
+                fileIndex, start, position = nextRange
+                data = self.downloadRange(fileIndex, start, position)
+
+                if not self.putPrefetched((fileIndex, position, data)):
+                    return
+
+                self.prefetchFrom = (fileIndex, position)
+
+        except Exception as e:
+
+            logger.exception("Error prefetching results for query '%s'" % self.queryHandle)
+            self.putPrefetched(e)
+
+    def putPrefetched(self, item):
+        """
+        Queues a prefetched item, waiting for the reader to make room
+
+        Args:
+            item: a (fileIndex, position, data) tuple, an exception or
+                None at the end of the results
+        Returns:
+            whether the item was queued, False once the cursor is closed
+            or has gone unread for PREFETCH_IDLE_SECONDS
+        """
+
+        while not self.closed:
 
             try:
+                self.prefetchQueue.put(item, timeout=1)
+                return True
+            except Full:
+                pass
 
-                key = self.bucket.get_key(self.currentFile, validate=False)
-                data = key.get_contents_as_string(
-                    headers={
-                        "Range": "bytes=%s-%s" % (
-                            self.currentFilePosition,
-                            self.currentFilePosition+self.CHUNK_SIZE
-                        )
-                    }
-                )
-                self.currentFilePosition += self.CHUNK_SIZE
-
-                return data
-
-            except S3ResponseError as e:
-
-                if e.status == 416:
-                    if len(self.filesLeft) > 0:
-                        self.currentFile = self.filesLeft[0]
-                        self.filesLeft = self.filesLeft[1:]
-                        self.currentFilePosition = 0
-                    else:
-                        return None
-                else:
-                    raise
+            with self.prefetchLock:
+                if time.time() - self.lastRead > self.PREFETCH_IDLE_SECONDS:
+                    # the next read starts a new worker from prefetchFrom,
+                    # which re-downloads the item that was dropped here
+                    self.prefetchThread = None
+                    return False
 
-    def fetch(self):
+        return False
+
+    def close(self):
+        """
+        Stops any background read-ahead for this cursor
+        """
+
+        self.closed = True
+
+    def getMoreData(self):
 
-        while True:
+        if self.prefetchChunks > 0:
 
-            if self.needsData:
+            with self.prefetchLock:
+                self.lastRead = time.time()
+                if self.prefetchThread is None:
+                    self.prefetchThread = Thread(target=self.prefetch)
+                    self.prefetchThread.daemon = True
+                    self.prefetchThread.start()
 
-                newData = self.getMoreData()
-                if newData is None:
+            item = self.prefetchQueue.get()
+            if item is None or isinstance(item, Exception):
+                # leave the final item in place for any later reads
+                self.prefetchQueue.put(item)
+                if item is None:
                     return None
-                self.data += newData
-                self.curPos = 0
-                self.needsData = False
-
-            newPos = self.data.find("\n", self.curPos)
-            if newPos == -1:
-                self.data = self.data[self.curPos:]
-                self.needsData = True
+                raise item
+
+            self.fileIndex, self.currentFilePosition, data = item
+
+            return data
+
+        nextRange = self.nextRange(self.fileIndex, self.currentFilePosition)
+        if nextRange is None:
+            return None
+
+        fileIndex, start, end = nextRange
+        data = self.downloadRange(fileIndex, start, end)
+        self.fileIndex, self.currentFilePosition = fileIndex, end
+
+        return data
+
+    def bufferRows(self):
+        """
+        Downloads chunks until at least one complete row is available
+        and splits every complete row in the buffer in a single pass
+
+        Returns:
+            False if there is no more data to read, True otherwise
+        """
+
+        while not self.exhausted:
+
+            newData = self.getMoreData()
+
+            if newData is None:
+
+                self.exhausted = True
+
+                # flush a final row that wasn't newline terminated
+                if len(self.data) > 0:
+                    self.rows = [str(self.data).split("\t")]
+                    self.rowPos = 0
+                    self.rowBytes = len(self.data)
+                    self.rowsStart = self.dataStart
+                    self.dataStart = self.advance(self.dataStart, len(self.data))
+                    self.data = bytearray()
+                    return True
+
+                return False
+
+            self.data.extend(newData)
+
+            lastPos = self.data.rfind("\n")
+            if lastPos == -1:
                 continue
-            row = self.data[self.curPos:newPos]
-            self.curPos = newPos+1
-            
-            return row.split("\t")
+
+            chunk = memoryview(self.data)[:lastPos].tobytes()
+            del self.data[:lastPos+1]
+
+            self.rows = [row.split("\t") for row in chunk.split("\n")]
+            self.rowPos = 0
+            self.rowBytes = len(chunk)
+            self.rowsStart = self.dataStart
+            self.dataStart = self.advance(self.dataStart, lastPos+1)
+            self.rowsSplit += len(self.rows)
+            self.bytesSplit += len(chunk)
+
+            return True
+
+        return False
+
+    def fetchMany(self, maxRows):
+        """
+        Fetches up to maxRows rows from the cursor
+
+        Args:
+            maxRows: the maximum number of rows to return
+        Returns:
+            a list of rows, which is empty once the results are exhausted
+        """
+
+        rows = []
+        while len(rows) < maxRows:
+
+            if self.rowPos >= len(self.rows):
+                self.rows = []
+                self.rowBytes = 0
+                self.requestRows(maxRows - len(rows))
+                if not self.bufferRows():
+                    break
+
+            end = self.rowPos + maxRows - len(rows)
+            rows.extend(self.rows[self.rowPos:end])
+            self.rowPos = min(end, len(self.rows))
+
+        return rows
+
+    def fetch(self):
+
+        rows = self.fetchMany(1)
+        if len(rows) == 0:
+            return None
+
+        return rows[0]
@@ -1,5 +1,6 @@
 # Standard Library
-import time
+import sys
+from collections import OrderedDict
 from threading import Lock
 
 # Third Party
@@ -7,27 +8,64 @@ from threading import Lock
 # Local
 
 
+def defaultSizeOf(item):
+    """
+    Estimates the number of bytes held by an item. Items that
+    know their own footprint can expose a memoryUsage method.
+
+    Args:
+        item: an item stored in the cache
+    Returns:
+        the approximate size of the item in bytes
+    """
+
+    if hasattr(item, 'memoryUsage'):
+        return item.memoryUsage()
+
+    return sys.getsizeof(item)
+
+
 class LRU():
 
-    def __init__(self, maxSize=1000):
-        self.maxSize = maxSize
-        self.lru = dict()
-        self.items = dict()
+    def __init__(self, maxBytes=1000*1024*1024, sizeOf=defaultSizeOf, onEvict=None):
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.onEvict = onEvict
+        self.items = OrderedDict()
+        self.sizes = dict()
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         self.lock = Lock()
 
+    def _setSize(self, id, item):
+
+        size = self.sizeOf(item)
+        self.totalBytes += size - self.sizes.get(id, 0)
+        self.sizes[id] = size
+
+    def _evict(self):
+
+        # the oldest entry is always at the front of the ordered dict,
+        # but never evict the only remaining entry
+        while self.totalBytes > self.maxBytes and len(self.items) > 1:
+            remKey, remItem = self.items.popitem(last=False)
+            self.totalBytes -= self.sizes.pop(remKey)
+            self.evictions += 1
+            if self.onEvict is not None:
+                self.onEvict(remItem)
+
     def add(self, id, item):
 
         self.lock.acquire()
 
         try:
 
-            if len(self.lru) > self.maxSize:
-                remKey = sorted(self.lru.items(), key=lambda x: x[1], reverse=True)[0][0]
-                del self.lru[remKey]
-                del self.items[remKey]
-
-            self.lru[id] = time.time()
+            self.items.pop(id, None)
             self.items[id] = item
+            self._setSize(id, item)
+            self._evict()
 
         finally:
 
@@ -40,10 +78,16 @@ class LRU():
         item = None
         try:
 
-            item = self.items.get(id,None)
+            item = self.items.pop(id, None)
             if item is not None:
-                self.lru[id] = time.time()
-        
+                # re-insert to mark as most recently used
+                self.items[id] = item
+                self._setSize(id, item)
+                self.hits += 1
+                self._evict()
+            else:
+                self.misses += 1
+
         finally:
 
             self.lock.release()
@@ -56,8 +100,33 @@ class LRU():
 
         try:
 
-            del self.lru[id]
-            del self.items[id]
+            item = self.items.pop(id)
+            self.totalBytes -= self.sizes.pop(id)
+            if self.onEvict is not None:
+                self.onEvict(item)
+
+        finally:
+
+            self.lock.release()
+
+    def stats(self):
+        """
+        Returns:
+            a dictionary of cache counters
+        """
+
+        self.lock.acquire()
+
+        try:
+
+            return {
+                "items": len(self.items),
+                "bytes": self.totalBytes,
+                "maxBytes": self.maxBytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
 
         finally:
 
@@ -0,0 +1,218 @@
+# Standard Library
+import itertools
+import logging
+import time
+from threading import Condition, Lock, Thread
+
+# Third Party
+
+# Local
+
+
+logger = logging.getLogger(__name__)
+
+
+class Watch():
+
+    def __init__(self, key):
+        self.key = key
+        self.data = None
+        self.status = None
+        self.version = 0
+        self.done = False
+        self.stopped = False
+        self.waiters = 0
+        self.callbacks = []
+        self.lastWaited = time.time()
+        self.condition = Condition()
+
+
+class ProgressHub():
+    """
+    Polls upstream progress once per key no matter how many clients
+    are waiting on it, and wakes the waiting clients when it changes
+    """
+
+    def __init__(self, fetch, interval=1.0, idleTimeout=30, maxRetryInterval=30, failureTimeout=600):
+        """
+        Args:
+            fetch: a function that takes a key and returns a
+                (data, status code) tuple
+            interval: seconds between upstream polls
+            idleTimeout: seconds to keep polling with no one waiting
+            maxRetryInterval: the most seconds to back off between
+                polls while upstream is failing
+            failureTimeout: seconds upstream can keep failing before
+                the failure is treated as final
+        """
+
+        self.fetch = fetch
+        self.interval = interval
+        self.idleTimeout = idleTimeout
+        self.maxRetryInterval = maxRetryInterval
+        self.failureTimeout = failureTimeout
+        self.watches = dict()
+        # versions increase across watches so that a client's last seen
+        # version stays meaningful if a watch is replaced
+        self.versions = itertools.count(1)
+        self.lock = Lock()
+
+    def _getWatch(self, key):
+
+        self.lock.acquire()
+
+        try:
+
+            watch = self.watches.get(key)
+            if watch is None:
+                watch = Watch(key)
+                self.watches[key] = watch
+                thread = Thread(target=self._poll, args=(watch,))
+                thread.daemon = True
+                thread.start()
+
+        finally:
+
+            self.lock.release()
+
+        return watch
+
+    def _poll(self, watch):
+
+        failures = 0
+        failingSince = None
+        while True:
+
+            try:
+                data, status = self.fetch(watch.key)
+            except Exception as e:
+                logger.exception("Error polling progress for '%s'" % (watch.key,))
+                data, status = {"error": str(e)}, 500
+
+            # only a stopped job or an unknown handle is final, anything
+            # else upstream returns is retried with a backoff
+            final = status == 404 or (status == 200 and not data.get("running", True))
+            failed = status != 200 and not final
+
+            if failed:
+                failures += 1
+                failingSince = failingSince or time.time()
+            else:
+                failures = 0
+                failingSince = None
+
+            gaveUp = failed and time.time() - failingSince > self.failureTimeout
+
+            with watch.condition:
+
+                # clients keep seeing the last good progress while retrying
+                if (not failed or gaveUp) and (data != watch.data or status != watch.status):
+                    self.lock.acquire()
+                    try:
+                        watch.version = self.versions.next()
+                    finally:
+                        self.lock.release()
+                    watch.data, watch.status = data, status
+
+                if final or gaveUp:
+                    watch.done = True
+
+                idle = watch.waiters == 0 and len(watch.callbacks) == 0 and \
+                    time.time() - watch.lastWaited > self.idleTimeout
+
+                callbacks = []
+                if watch.done or idle:
+                    watch.stopped = True
+                    callbacks, watch.callbacks = watch.callbacks, []
+
+                watch.condition.notify_all()
+
+            for callback in callbacks:
+                try:
+                    callback(data, status)
+                except Exception:
+                    logger.exception("Error notifying completion of '%s'" % (watch.key,))
+
+            if watch.done or idle:
+
+                self.lock.acquire()
+                try:
+                    if self.watches.get(watch.key) is watch:
+                        del self.watches[watch.key]
+                finally:
+                    self.lock.release()
+
+                return
+
+            if failures:
+                time.sleep(min(self.interval * 2 ** failures, self.maxRetryInterval))
+            else:
+                time.sleep(self.interval)
+
+    def notify(self, key, callback):
+        """
+        Calls a function once the progress for a key is final, or once
+        upstream has failed for longer than failureTimeout. The key is
+        polled until then even if no one is waiting on it.
+
+        Args:
+            key: a key understood by the fetch function
+            callback: a function that takes the final data and status code
+        """
+
+        while True:
+
+            watch = self._getWatch(key)
+
+            with watch.condition:
+
+                if not watch.stopped:
+                    watch.callbacks.append(callback)
+                    return
+
+                done = watch.done
+
+            # the watch stopped polling, either with a final result or
+            # because it went idle just before the callback was added
+            if done:
+                callback(watch.data, watch.status)
+                return
+
+            time.sleep(self.interval)
+
+    def wait(self, key, since=0, timeout=30):
+        """
+        Waits until the progress for a key is newer than a version
+        the client has already seen, or until a timeout passes
+
+        Args:
+            key: a key understood by the fetch function
+            since: the last version the client has seen
+            timeout: the max number of seconds to wait
+        Returns:
+            the latest data, status code, version and whether the
+            progress is final
+        """
+
+        watch = self._getWatch(key)
+        deadline = time.time() + timeout
+
+        with watch.condition:
+
+            watch.waiters += 1
+
+            try:
+
+                # always wait for the first upstream response
+                while (watch.version <= since and not watch.done) or watch.version == 0:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    watch.condition.wait(remaining)
+
+                return watch.data, watch.status, watch.version, watch.done
+
+            finally:
+
+                watch.waiters -= 1
+                watch.lastWaited = time.time()
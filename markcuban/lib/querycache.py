@@ -0,0 +1,146 @@
+# Standard Library
+import hashlib
+import json
+import re
+
+# Third Party
+from chassis.util import normalizeTableName
+
+# Local
+
+
+# quoted strings are kept verbatim while normalizing
+QUOTED_RE = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""")
+COMMENT_RE = re.compile(r"--[^\n]*")
+TOKEN_RE = re.compile(r"[\w.]+|[(),]")
+# results of queries calling these differ from run to run
+VOLATILE_RE = re.compile(r"\b(?:rand|random|now|unix_timestamp|current_timestamp|current_date|current_user|uuid|reflect|java_method|in_file)\b")
+WRITE_TABLE_RE = re.compile(r"\b(?:insert\s+(?:into|overwrite)\s+table|insert\s+into|create\s+(?:external\s+)?table(?:\s+if\s+not\s+exists)?|drop\s+table(?:\s+if\s+exists)?|alter\s+table|load\s+data\s+(?:local\s+)?inpath\s+\S+\s+(?:overwrite\s+)?into\s+table)\s+([\w.]+)")
+
+
+def normalizeSql(sql):
+    """
+    Normalizes a query so that trivially different spellings of the
+    same query share a cache entry. Whitespace is collapsed and
+    everything outside of quoted strings is lower cased.
+
+    Args:
+        sql: a sql query
+    Returns:
+        the normalized query
+    """
+
+    parts = QUOTED_RE.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", COMMENT_RE.sub(" ", parts[i])).lower()
+
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def _stripQuoted(normalizedSql):
+
+    # string literals are blanked, backquoted identifiers are kept
+    return QUOTED_RE.sub(lambda match: match.group(0).strip("`") if match.group(0).startswith("`") else "''",
+                         normalizedSql)
+
+
+def isCacheable(normalizedSql):
+    """
+    Returns:
+        whether a query is a single statement that reads the same
+        results every time it runs against the same tables
+    """
+
+    if not (normalizedSql.startswith("select ") or normalizedSql.startswith("with ")):
+        return False
+
+    stripped = _stripQuoted(normalizedSql)
+
+    return ";" not in stripped and not VOLATILE_RE.search(stripped)
+
+
+def _readTables(tokens, start, isFrom):
+
+    # a join names one table, a from names a comma separated list of
+    # tables and subqueries, each optionally followed by an alias
+    tables = []
+    i = start
+    while i < len(tokens):
+
+        if tokens[i] == "(":
+            # tables inside a subquery are found by their own from
+            depth = 0
+            while i < len(tokens):
+                if tokens[i] == "(":
+                    depth += 1
+                elif tokens[i] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+        elif tokens[i] not in (")", ","):
+            tables.append(tokens[i])
+        else:
+            break
+        i += 1
+
+        if i < len(tokens) and tokens[i] == "as":
+            i += 1
+        if i < len(tokens) and tokens[i] not in ("(", ")", ","):
+            i += 1
+
+        if not isFrom or i >= len(tokens) or tokens[i] != ",":
+            break
+        i += 1
+
+    return tables
+
+
+def referencedTables(normalizedSql):
+    """
+    Returns:
+        the sorted, de-duplicated tables a query reads from
+    """
+
+    tokens = TOKEN_RE.findall(_stripQuoted(normalizedSql))
+
+    tables = []
+    for i, token in enumerate(tokens):
+        if token in ("from", "join"):
+            tables.extend(_readTables(tokens, i + 1, token == "from"))
+
+    return sorted(set([normalizeTableName(table) for table in tables]))
+
+
+def writtenTables(normalizedSql):
+    """
+    Returns:
+        the tables a statement creates, alters, drops or writes to
+    """
+
+    return sorted(set([normalizeTableName(table) for table in
+                       WRITE_TABLE_RE.findall(_stripQuoted(normalizedSql))]))
+
+
+def makeCacheKey(account, cluster, normalizedSql, options, tableVersions):
+    """
+    Builds a result cache key. Bumping the version of any table the
+    query reads from changes the key, which invalidates the entry.
+
+    Args:
+        account: an account id
+        cluster: the cluster the query runs on
+        normalizedSql: a query normalized with normalizeSql
+        options: the query options as a dictionary
+        tableVersions: a dictionary of table name to version
+    Returns:
+        a cache key
+    """
+
+    return hashlib.sha1(json.dumps([
+        str(account),
+        str(cluster),
+        normalizedSql,
+        options,
+        sorted(tableVersions.items())
+    ], sort_keys=True)).hexdigest()
@@ -0,0 +1,66 @@
+# Standard Library
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# Third Party
+
+# Local
+
+
+class TTLCache():
+
+    def __init__(self, ttl=300, maxItems=1000):
+        self.ttl = ttl
+        self.maxItems = maxItems
+        # values are (expires, item), oldest insert first
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def set(self, key, item, ttl=None):
+
+        self.lock.acquire()
+
+        try:
+
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + (ttl or self.ttl), item)
+
+            while len(self.items) > self.maxItems:
+                self.items.popitem(last=False)
+
+        finally:
+
+            self.lock.release()
+
+    def get(self, key):
+
+        self.lock.acquire()
+
+        item = None
+        try:
+
+            entry = self.items.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    item = entry[1]
+                else:
+                    del self.items[key]
+
+        finally:
+
+            self.lock.release()
+
+        return item
+
+    def remove(self, key):
+
+        self.lock.acquire()
+
+        try:
+
+            self.items.pop(key, None)
+
+        finally:
+
+            self.lock.release()
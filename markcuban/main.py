@@ -3,23 +3,31 @@
 
 # Standard Library
 import argparse
+import csv
 import json
 import logging
-import requests
+import math
+import re
 import time
 import uuid
+import zlib
+from cStringIO import StringIO
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from threading import Thread, Lock 
 
 # Third Party
 import mixingboard
+import redis
+from chassis import httpclient
+from chassis.aws import getS3Conn
 from chassis.database import db_session, init_db
 from chassis.models import Account, Query, JobHistory
-from chassis.util import processFormattedTableDescription
-from flask import Flask, jsonify, request, g
+from chassis.util import bumpTableVersion, normalizeTableName, processFormattedTableDescription, tableVersionsKey
+from flask import Flask, Response, jsonify, request, g, stream_with_context
 
 # Local
-from lib import Cursor, LRU
+from lib import Cursor, LRU, ProgressHub, TTLCache, columnar, querycache
 
 
 # parse arguments
@@ -29,7 +37,15 @@ argParser.add_argument('-p', '--port', type=int, default=32123, help='Set the po
 argParser.add_argument('-H', '--host', type=str, default="127.0.0.1", help='Set the host')
 argParser.add_argument('-c', '--command', type=str, default='serve', help='Operation to perform (serve, db)')
 argParser.add_argument('-C', '--cache-size', type=int, default=1000, help='The max cache size in mega bytes')
+argParser.add_argument('-M', '--max-chunk-size', type=int, default=16, help='The largest S3 range a cursor reads at once in mega bytes')
+argParser.add_argument('-S', '--shared-cursors', action='store_true', help='Checkpoint cursors to redis so any markcuban node can resume them')
+argParser.add_argument('--result-cache-ttl', type=int, default=0, help='Seconds to reuse the results of identical queries (0 disables the result cache)')
+argParser.add_argument('--result-cache-size', type=int, default=10000, help='The max number of cached query results')
+argParser.add_argument('--metadata-cache-ttl', type=int, default=0, help='Seconds to cache table lists and schemas (0 disables the metadata cache)')
+argParser.add_argument('-P', '--prefetch-chunks', type=int, default=2, help='Number of result chunks each cursor reads ahead (0 disables prefetching)')
+httpclient.addArguments(argParser)
 args, _ = argParser.parse_known_args()
+httpclient.configureFromArgs(args)
 
 # extract arguments to sane, all caps variable names
 DEBUG = args.debug
@@ -37,6 +53,12 @@ HOST = args.host
 PORT = args.port
 COMMAND = args.command
 CACHE_SIZE = args.cache_size
+PREFETCH_CHUNKS = args.prefetch_chunks
+MAX_CHUNK_SIZE = args.max_chunk_size
+SHARED_CURSORS = args.shared_cursors
+RESULT_CACHE_TTL = args.result_cache_ttl
+RESULT_CACHE_SIZE = args.result_cache_size
+METADATA_CACHE_TTL = args.metadata_cache_ttl
 
 
 # set up logging
@@ -54,19 +76,68 @@ def shutdown_session(exception=None):
 
 # set up globals for managing cursors
 global cursors
-cursors = LRU(maxSize=CACHE_SIZE)
+cursors = LRU(maxBytes=CACHE_SIZE*1024*1024, onEvict=lambda cursor: cursor.close())
 
 
-# setup flint configurations
-global FLINT_URL_FORMAT
-FLINT_URL_FORMAT = None
-def setFlintURLFormat(flintServers):
-    global FLINT_URL_FORMAT
-    flint = flintServers[0]
-    FLINT_URL_FORMAT = "http://%s:%s/flint/" % (flint["host"], flint["port"])
-    logging.info("GOT FLINT SERVICE: %s" % FLINT_URL_FORMAT)
+# caches that let repeated cursor opens skip the account lookup,
+# the S3 connection setup and the result listing
+global accountCache, bucketCache, listingCache
+accountCache = TTLCache(ttl=5*60, maxItems=10000)
+bucketCache = TTLCache(ttl=60*60, maxItems=1000)
+listingCache = TTLCache(ttl=5*60, maxItems=10000)
 
-mixingboard.discoverService("flint",setFlintURLFormat)
+
+# query results are reused until a table they read from changes, table
+# versions are kept in redis so that every service can bump them
+global resultCache, cachedHandles
+resultCache = None
+cachedHandles = None
+if RESULT_CACHE_TTL:
+    resultCache = TTLCache(ttl=RESULT_CACHE_TTL, maxItems=RESULT_CACHE_SIZE)
+    # handles handed out from the result cache, their job server may no
+    # longer know them so their final status is answered from here
+    cachedHandles = TTLCache(ttl=RESULT_CACHE_TTL, maxItems=RESULT_CACHE_SIZE)
+
+
+# table lists and schemas per account and cluster, the table versions
+# above are part of each key so changes anywhere invalidate them
+METADATA_WARM_THREADS = 4
+
+global metadataCache
+metadataCache = None
+if METADATA_CACHE_TTL:
+    metadataCache = TTLCache(ttl=METADATA_CACHE_TTL, maxItems=100000)
+
+
+# a single upstream poller per query handle serves every long-poll client
+PROGRESS_POLL_INTERVAL = 1.0
+MAX_PROGRESS_WAIT = 60
+SSE_KEEPALIVE = 15
+
+global progressHub
+progressHub = ProgressHub(lambda key: fetchQueryProgress(*key), interval=PROGRESS_POLL_INTERVAL)
+
+# completion events for watched handles are published on this redis channel
+JOB_EVENTS_CHANNEL = "jobevents"
+
+global eventsClient
+eventsClient = None
+
+
+# shared cursor state lives in redis so that any node can resume a cursor,
+# the same client keeps the table versions of the result and metadata
+# caches but cursors are only checkpointed with --shared-cursors
+CURSOR_TTL = 60*60*24
+
+global redisClient
+redisClient = None
+if SHARED_CURSORS or RESULT_CACHE_TTL or METADATA_CACHE_TTL:
+    redisInfo = mixingboard.getConf('redis')
+    redisClient = redis.StrictRedis(host=redisInfo['host'], port=int(redisInfo['port']), db=0)
+
+
+# setup service balancers
+FLINT = mixingboard.getBalancer("flint", "/flint/")
 
 
 def makeHistory(accountId, userId, event, jobId=None, jobHandle=None, data={}):
@@ -126,8 +197,9 @@ def getHostInfos(account, user, cluster):
 
 def getHostInfo(account, user, cluster):
     """
-    Retrieves the first job-server info for a given 
-    account/user combo
+    Retrieves the job-server info for a given account/user combo.
+    Query handles live on a single job server, so this sticks to
+    the first healthy one.
 
     Args:
         account: an account id
@@ -137,7 +209,7 @@ def getHostInfo(account, user, cluster):
         a dictionary containing host information
     """
 
-    return getHostInfos(account, user, cluster)[0]
+    return mixingboard.getBalancer('job-server', account=account, cluster=cluster, strategy="first").pick()
 
 
 def getSharkURL(account, user, cluster):
@@ -211,15 +283,158 @@ def getRequestParameters(forceHandle=False, forceCluster=True):
     return None, user, account, cluster, handle
 
 
+def getTableVersions(account, tables):
+    """
+    Retrieves the current version of each table
+
+    Args:
+        account: an account id
+        tables: a list of normalized table names
+    Returns:
+        a dictionary of table name to version
+    """
+
+    if len(tables) == 0:
+        return {}
+
+    versions = redisClient.hmget(tableVersionsKey(account), tables)
+
+    return {
+        table: int(version or 0)
+        for table, version in zip(tables, versions)
+    }
+
+
+def tablesChanged(account, query):
+    """
+    Bumps the version of every table a statement writes to
+    so that cached results reading from them are no longer used
+
+    Args:
+        account: an account id
+        query: a sql statement that ran successfully
+    """
+
+    if redisClient is None:
+        return
+
+    for table in querycache.writtenTables(querycache.normalizeSql(query)):
+        bumpTableVersion(redisClient, account, table)
+
+
+def getCachedQuery(account, cluster, query, options):
+    """
+    Looks up a previous run of a query against the same table versions
+
+    Args:
+        account: an account id
+        cluster: the cluster the query runs on
+        query: a sql query
+        options: the query options
+    Returns:
+        the cache key, or None if the query can't be cached
+        the previous run or None
+    """
+
+    if resultCache is None or (request.values.get('cache') or '').lower() == 'false':
+        return None, None
+
+    normalizedSql = querycache.normalizeSql(query)
+    if not querycache.isCacheable(normalizedSql):
+        return None, None
+
+    if isinstance(options, basestring):
+        options = json.loads(options)
+
+    tableVersions = getTableVersions(account, querycache.referencedTables(normalizedSql))
+    cacheKey = querycache.makeCacheKey(account, cluster, normalizedSql, options or {}, tableVersions)
+
+    return cacheKey, resultCache.get(cacheKey)
+
+
+def getCachedHandle(account, handle, kind):
+    """
+    Answers for a handle that was handed out from the result cache
+
+    Args:
+        account: an account id
+        handle: a shark client handle
+        kind: one of 'status', 'progress' or 'results'
+    Returns:
+        the final response of that kind, or None if the handle
+        didn't come from the result cache
+    """
+
+    if cachedHandles is None:
+        return None
+
+    cached = cachedHandles.get((str(account), handle))
+    if cached is None:
+        return None
+
+    return cached[kind], 200
+
+
+def queryFinished(account, user, cluster, query, cacheKey, response):
+    """
+    Makes a progress hub callback that runs once an async query stops
+    running. Tables the query wrote to are bumped again, since results
+    cached while it ran were read from the old data, and successful
+    queries are added to the result cache.
+
+    Args:
+        account: an account id
+        user: a user id
+        cluster: the cluster the query ran on
+        query: the sql query
+        cacheKey: the result cache key or None
+        response: the response to the query's submission
+    Returns:
+        a function that takes the final progress and status code
+    """
+
+    def finished(progress, statusCode):
+
+        tablesChanged(account, query)
+
+        if cacheKey is None or statusCode != 200:
+            return
+
+        handle = response['handle']
+
+        results, resultsCode = fetchQueryResults(account, user, handle)
+        if resultsCode != 200 or \
+                (isinstance(results.get('results'), dict) and 'error' in results['results']):
+            return
+
+        status, statusCode = fetchQueryStatus(account, user, cluster, handle)
+        if statusCode != 200:
+            return
+
+        resultCache.set(cacheKey, {
+            "response": response,
+            "status": status,
+            "progress": progress,
+            "results": results
+        })
+
+    return finished
+
+
 def executeQueryAsync(query, options):
 
     error, user, account, cluster, _ = getRequestParameters()
     if error:
         return error, 400
 
+    cacheKey, cached = getCachedQuery(account, cluster, query, options)
+    if cached is not None:
+        cachedHandles.set((str(account), cached['response']['handle']), cached)
+        return dict(cached['response'], cached=True), 200
+
     sharkURL = getSharkURL(account, user, cluster)
 
-    res = requests.post("%s/spark/sql/run" % sharkURL, data={
+    res = httpclient.post("%s/spark/sql/run" % sharkURL, data={
         "account": account,
         "user": user,
         "sql": query,
@@ -228,8 +443,16 @@ def executeQueryAsync(query, options):
 
     data = json.loads(res.text)
 
-    if isinstance(options, basestring):
-        options = json.loads(options)
+    if res.status_code == 200:
+
+        tablesChanged(account, query)
+
+        # results are only cached, and written tables only settle,
+        # once the query has finished
+        writes = redisClient is not None and querycache.writtenTables(querycache.normalizeSql(query))
+        if cacheKey is not None or writes:
+            progressHub.notify((account, user, cluster, data['handle']),
+                               queryFinished(account, user, cluster, query, cacheKey, data))
 
     return data, res.status_code
 
@@ -240,9 +463,18 @@ def getQueryStatus():
     if error:
         return error, 400
 
-    sharkURL = getSharkURL(account, user, cluster)
+    return fetchQueryStatus(account, user, cluster, handle)
 
-    res = requests.get("%s/spark/job/async/status" % sharkURL, params={
+
+def fetchQueryStatus(account, user, cluster, handle, sharkURL=None):
+
+    cached = getCachedHandle(account, handle, "status")
+    if cached is not None:
+        return cached
+
+    sharkURL = sharkURL or getSharkURL(account, user, cluster)
+
+    res = httpclient.get("%s/spark/job/async/status" % sharkURL, params={
         "account": account,
         "user": user,
         "handle": handle
@@ -257,9 +489,18 @@ def getQueryProgress():
     if error:
         return error, 400
 
-    sharkURL = getSharkURL(account, user, cluster)
+    return fetchQueryProgress(account, user, cluster, handle)
+
+
+def fetchQueryProgress(account, user, cluster, handle, sharkURL=None):
 
-    res = requests.get("%s/spark/job/async/progress" % sharkURL, params={
+    cached = getCachedHandle(account, handle, "progress")
+    if cached is not None:
+        return cached
+
+    sharkURL = sharkURL or getSharkURL(account, user, cluster)
+
+    res = httpclient.get("%s/spark/job/async/progress" % sharkURL, params={
         "account": account,
         "user": user,
         "handle": handle
@@ -268,13 +509,91 @@ def getQueryProgress():
     return json.loads(res.text), res.status_code
 
 
+BATCH_THREADS = 8
+
+def fetchBatch(fetch):
+    """
+    Runs a status or progress lookup for many handles at once.
+    Handles are grouped by cluster so each job server is looked
+    up once, and the upstream requests run concurrently.
+
+    GetParams:
+        handles: a json list of handles, or of {"handle", "cluster"}
+            objects for handles on other clusters than the cluster param
+    Args:
+        fetch: fetchQueryStatus or fetchQueryProgress
+    Returns:
+        a dictionary of handle to {"status", "data"}
+        a status code
+    """
+
+    error, user, account, cluster, _ = getRequestParameters(forceCluster=False)
+    if error:
+        return error, 400
+
+    try:
+        handles = json.loads(request.values.get('handles', '[]'))
+    except ValueError:
+        return {
+            "error": "handles must be a json list"
+        }, 400
+
+    byCluster = defaultdict(list)
+    for handle in handles:
+        if isinstance(handle, dict):
+            byCluster[handle.get('cluster', cluster)].append(handle['handle'])
+        else:
+            byCluster[cluster].append(handle)
+
+    if None in byCluster:
+        return {
+            "error": "You must specify a cluster"
+        }, 400
+
+    sharkURLs = {
+        handleCluster: getSharkURL(account, user, handleCluster)
+        for handleCluster in byCluster.keys()
+    }
+
+    jobs = [(handleCluster, handle) for handleCluster, clusterHandles in byCluster.items()
+                                    for handle in clusterHandles]
+
+    def fetchOne(job):
+        handleCluster, handle = job
+        try:
+            data, statusCode = fetch(account, user, handleCluster, handle, sharkURL=sharkURLs[handleCluster])
+        except Exception as e:
+            data, statusCode = {"error": str(e)}, 500
+        return handle, {
+            "status": statusCode,
+            "data": data
+        }
+
+    pool = ThreadPool(min(BATCH_THREADS, max(len(jobs), 1)))
+    try:
+        results = pool.map(fetchOne, jobs)
+    finally:
+        pool.close()
+
+    return dict(results), 200
+
+
 def getQueryResults():
 
     error, user, account, cluster, handle = getRequestParameters(forceCluster=False)
     if error:
         return error, 400
 
-    res = requests.get("%sspark/job/async/results" % FLINT_URL_FORMAT, params={
+    return fetchQueryResults(account, user, handle)
+
+
+def fetchQueryResults(account, user, handle):
+
+    cached = getCachedHandle(account, handle, "results")
+    if cached is not None:
+        return cached
+
+    res = FLINT.get("spark/job/async/results", params={
         "account": account,
         "user": user,
         "handle": handle
@@ -282,6 +601,143 @@ def getQueryResults():
 
     return json.loads(res.text), res.status_code
 
+def makeCursor(account, handle, **kwargs):
+    """
+    Creates a cursor over the results of a query
+
+    Args:
+        account: an account id
+        handle: a shark client handle
+        kwargs: extra arguments for the cursor
+    Returns:
+        a new cursor
+    """
+
+    iamUsername, accessKeyId, accessKeySecret, region = getAccountCredentials(account)
+
+    if 'listing' not in kwargs:
+        kwargs['listing'] = listingCache.get((account, handle))
+
+    cursor = Cursor(iamUsername, accessKeyId, accessKeySecret, region, handle,
+                    prefetchChunks=PREFETCH_CHUNKS, maxChunkSize=MAX_CHUNK_SIZE*1024*1024,
+                    bucket=getBucket(accessKeyId, accessKeySecret, region), **kwargs)
+
+    # results don't change once written, so share the listing
+    # with every other cursor over the same query
+    if kwargs['listing'] is None and len(cursor.queryListing) > 0:
+        listingCache.set((account, handle), cursor.queryListing)
+
+    return cursor
+
+def getAccountCredentials(account):
+    """
+    Retrieves the S3 credentials of an account, caching them
+    for a few minutes
+
+    Args:
+        account: an account id
+    Returns:
+        the iam username, access key id, access key secret and region
+    """
+
+    credentials = accountCache.get(account)
+
+    if credentials is None:
+        accountObj = Account.query.filter(Account.id==account).first()
+        credentials = (accountObj.iam_username, accountObj.access_key_id,
+                       accountObj.access_key_secret, accountObj.region)
+        accountCache.set(account, credentials)
+
+    return credentials
+
+def getBucket(accessKeyId, accessKeySecret, region):
+    """
+    Retrieves a results bucket handle from a pool of S3
+    connections keyed by credentials and region
+
+    Args:
+        accessKeyId: an aws access key id
+        accessKeySecret: an aws access key secret
+        region: an aws region
+    Returns:
+        a boto bucket
+    """
+
+    key = (accessKeyId, accessKeySecret, region)
+    bucket = bucketCache.get(key)
+
+    if bucket is None:
+        s3Conn = getS3Conn(accessKeyId, accessKeySecret, region=region)
+        bucket = s3Conn.get_bucket(mixingboard.getConf("s3_bucket"), validate=False)
+        bucketCache.set(key, bucket)
+
+    return bucket
+
+def saveCursor(account, cursor, created=False):
+    """
+    Checkpoints the position of a cursor to redis when
+    cursors are shared between nodes
+
+    Args:
+        account: the account id that owns the cursor
+        cursor: a cursor
+        created: whether the cursor is new, the parts of a cursor
+            that never change are only saved then
+    """
+
+    if not SHARED_CURSORS:
+        return
+
+    cursor.version += 1
+
+    state = cursor.getState(withListing=created)
+    if created:
+        state['account'] = account
+
+    pipe = redisClient.pipeline()
+    pipe.hmset('cursor:%s' % cursor.handle, state)
+    pipe.expire('cursor:%s' % cursor.handle, CURSOR_TTL)
+    pipe.execute()
+
+def getCursor(account, handle):
+    """
+    Retrieves a cursor, resuming it from its redis checkpoint
+    if this node doesn't hold it or holds a stale copy
+
+    Args:
+        account: an account id
+        handle: a cursor handle
+    Returns:
+        a cursor or None if there is no cursor with that handle
+    """
+
+    cursor = cursors.get(handle)
+
+    if not SHARED_CURSORS:
+        return cursor
+
+    if cursor is not None:
+        version = redisClient.hget('cursor:%s' % handle, 'version')
+        if version is None or int(version) == cursor.version:
+            return cursor
+
+    state = redisClient.hgetall('cursor:%s' % handle)
+    if 'listing' not in state:
+        return cursor
+
+    if str(state['account']) != str(account):
+        return None
+
+    if cursor is not None:
+        cursor.close()
+
+    listing = [tuple(entry) for entry in json.loads(state['listing'])]
+    cursor = makeCursor(account, state['queryHandle'], handle=handle, listing=listing)
+    cursor.setState(state)
+    cursors.add(handle, cursor)
+
+    return cursor
+
 def cursor():
     global cursors
 
@@ -289,34 +745,60 @@ def cursor():
     if error:
         return error, 400
 
-    accountObj = Account.query.filter(Account.id==account).first()
-    cursor = Cursor(accountObj.iam_username, accountObj.access_key_id,
-                    accountObj.access_key_secret, accountObj.region, handle)
+    cursor = makeCursor(account, handle)
+
+    # an optional schema lets fetchn return typed columnar pages
+    schema = request.args.get('schema') or request.form.get('schema')
+    table = request.args.get('table') or request.form.get('table')
+    if schema:
+        try:
+            columns = json.loads(schema)
+        except ValueError:
+            columns = None
+        if not isinstance(columns, list) or not all([isinstance(column, dict) and
+                                                     isinstance(column.get('name'), basestring) and
+                                                     isinstance(column.get('type'), basestring)
+                                                     for column in columns]):
+            return {
+                "error": "schema must be a json list of {\"name\", \"type\"} objects"
+            }, 400
+        cursor.columns = columns
+    elif table:
+        database = request.args.get('database') or request.form.get('database') or 'default'
+        data, statusCode = describeTable(database, table)
+        if statusCode != 200:
+            return data, statusCode
+        cursor.columns = data['columns']
+
     cursors.add(cursor.handle, cursor)
+    saveCursor(account, cursor, created=True)
 
     return {
         "handle": cursor.handle 
     }, 200
 
-def fetchN(maxRows=10000):
+def fetchN(maxRows=10000, pageFormat="json"):
     global cursors
 
     error, user, account, _, handle = getRequestParameters(forceCluster=False)
     if error:
         return error, 400
 
-    cursor = cursors.get(handle)
+    cursor = getCursor(account, handle)
     if cursor is None:
         return {
             "error": "There is no cursor with that handle"
         }, 404
 
-    rows = []
-    while len(rows) < maxRows:
-        row = cursor.fetch()
-        if not row:
-            break
-        rows.append(row)
+    rows = cursor.fetchMany(maxRows)
+    saveCursor(account, cursor)
+
+    if pageFormat == "columnar":
+        # a schema that doesn't fit the rows, e.g. a table's schema for a
+        # query that selects other columns, falls back to untyped strings
+        if cursor.columns is not None and any([len(row) != len(cursor.columns) for row in rows]):
+            cursor.columns = None
+        return columnar.encodePage(rows, cursor.columns), 200
 
     return {
         "rows": rows
@@ -329,17 +811,127 @@ def executeQuerySync(query):
     if error:
         return error, 400
 
+    return runQuerySync(account, user, cluster, query)
+
+
+def runQuerySync(account, user, cluster, query):
+
     sharkURL = getSharkURL(account, user, cluster)
 
-    res = requests.post("%s/spark/sql/run/sync" % sharkURL, data={
+    res = httpclient.post("%s/spark/sql/run/sync" % sharkURL, data={
         "account": account,
         "user": user,
         "sql": query
     })
 
+    if res.status_code == 200:
+        tablesChanged(account, query)
+
     return json.loads(res.text), res.status_code
 
 
+def getMetadataCacheKey(account, cluster, kind, versionName):
+    """
+    Builds a metadata cache key that changes whenever the
+    table or database it describes changes
+
+    Args:
+        account: an account id
+        cluster: a cluster id
+        kind: the kind of metadata, 'tables' or 'schema'
+        versionName: the table version to key on
+    Returns:
+        a cache key, or None if the metadata cache is disabled
+    """
+
+    if metadataCache is None:
+        return None
+
+    version = getTableVersions(account, [versionName])[versionName]
+
+    return (str(account), cluster, kind, versionName, version)
+
+
+def getTableList(account, user, cluster, database):
+    """
+    Retrieves the tables in a database, using the metadata
+    cache if it is enabled
+
+    Returns:
+        a dictionary containing a list of tables
+        a status code
+    """
+
+    cacheKey = getMetadataCacheKey(account, cluster, "tables", "%s.*" % database.lower())
+    if cacheKey is not None:
+        data = metadataCache.get(cacheKey)
+        if data is not None:
+            return data, 200
+
+    data, statusCode = runQuerySync(account, user, cluster, "SHOW TABLES IN %s" % database)
+
+    if statusCode == 200:
+        data = {
+            "tables": [row[0] for row in data['rows'] if row[0][0:2] != "__"]
+        }
+        if cacheKey is not None:
+            metadataCache.set(cacheKey, data)
+
+    return data, statusCode
+
+
+def getTableDescription(account, user, cluster, database, table):
+    """
+    Retrieves the columns of a table with DESC FORMATTED, using
+    the metadata cache if it is enabled
+
+    Returns:
+        a dictionary containing the columns and whether the table is cached
+        a status code
+    """
+
+    cacheKey = getMetadataCacheKey(account, cluster, "schema", normalizeTableName("%s.%s" % (database, table)))
+    if cacheKey is not None:
+        data = metadataCache.get(cacheKey)
+        if data is not None:
+            return data, 200
+
+    data, statusCode = runQuerySync(account, user, cluster, "DESC FORMATTED %s.%s" % (database, table))
+
+    if statusCode != 200:
+        return data, statusCode
+
+    cols, cached = processFormattedTableDescription(data['rows'])
+
+    data = {
+        "columns": cols,
+        "cached": cached
+    }
+    if cacheKey is not None:
+        metadataCache.set(cacheKey, data)
+
+    return data, 200
+
+
+def describeTable(database, table):
+    """
+    Retrieves the columns of a table for the current request
+
+    Args:
+        database: Name of the shark database
+        table: the name of the table
+    Returns:
+        a dictionary containing the columns and whether the table is cached
+        a status code
+    """
+
+    error, user, account, cluster, _ = getRequestParameters()
+    if error:
+        return error, 400
+
+    return getTableDescription(account, user, cluster, database, table)
+
+
 @app.route('/shark/database/<database>/tables')
 def shark_tables(database):
     """
@@ -354,17 +946,59 @@ def shark_tables(database):
         json string containing a list of shark tables
     """
 
-    data, statusCode = executeQuerySync("SHOW TABLES IN %s" % database)
-    logging.info(data)
+    error, user, account, cluster, _ = getRequestParameters()
+    if error:
+        return jsonify(error), 400
 
-    if statusCode == 200:
-        data = {
-            "tables": [row[0] for row in data['rows'] if row[0][0:2] != "__"]
-        }
+    data, statusCode = getTableList(account, user, cluster, database)
 
     return jsonify(data), statusCode
 
 
+@app.route('/shark/database/<database>/warm', methods=["POST"])
+def shark_database_warm(database):
+    """
+    Loads the table list and every table schema of a database
+    into the metadata cache
+
+    PostParams:
+        account: an account
+        user: a user
+        cluster: a cluster
+    RouteParams:
+        database: Name of the shark database
+    Returns:
+        json string containing the number of tables warmed
+    """
+
+    if metadataCache is None:
+        return jsonify({
+            "error": "The metadata cache is disabled"
+        }), 400
+
+    error, user, account, cluster, _ = getRequestParameters()
+    if error:
+        return jsonify(error), 400
+
+    data, statusCode = getTableList(account, user, cluster, database)
+    if statusCode != 200:
+        return jsonify(data), statusCode
+
+    def warmTable(table):
+        return getTableDescription(account, user, cluster, database, table)[1]
+
+    pool = ThreadPool(METADATA_WARM_THREADS)
+    try:
+        statusCodes = pool.map(warmTable, data['tables'])
+    finally:
+        pool.close()
+
+    return jsonify({
+        "tables": len([code for code in statusCodes if code == 200]),
+        "failed": len([code for code in statusCodes if code != 200])
+    })
+
+
 @app.route('/shark/tables')
 def shark_tables_default():
     """
@@ -396,19 +1030,12 @@ def shark_table_schema(database, table):
         json string containing a schema description
     """
     
-    data, statusCode = executeQuerySync("DESC FORMATTED %s.%s" % (database, table))
+    data, statusCode = describeTable(database, table)
 
     if statusCode != 200:
         return jsonify(data), 200
 
-    rows = data['rows']
-
-    cols, cached = processFormattedTableDescription(rows)
-
-    return jsonify({
-        "columns": cols,
-        "cached": cached
-    })
+    return jsonify(data)
 
 
 @app.route('/shark/table/<table>/schema')
@@ -764,6 +1391,13 @@ def make_cursor():
         account: an account
         user: a user
         handle: a shark client handle
+        schema: (optional) a json list of {"name", "type"} columns used
+            for columnar pages
+        database: (optional) the database of the table below
+        table: (optional) a table whose schema is used for columnar pages,
+            only meaningful for queries that select every column of it.
+            Pages whose rows don't match the schema's width are untyped,
+            as are columns with values that don't parse as their type.
     Returns:
         a json object container the cursor handle
     """
@@ -773,6 +1407,50 @@ def make_cursor():
     return jsonify(data), statusCode
 
 
+@app.route('/shark/cursor/info')
+def cursor_info():
+    """
+    Retrieves the read throughput of a cursor
+
+    GetParams:
+        account: an account
+        user: a user
+        handle: a cursor handle
+    Returns:
+        a json object containing the chunk count and bytes per second
+            of the cursor
+    """
+
+    error, user, account, _, handle = getRequestParameters(forceHandle=True, forceCluster=False)
+    if error:
+        return jsonify(error), 400
+
+    cursor = getCursor(account, handle)
+    if cursor is None:
+        return jsonify({
+            "error": "There is no cursor with that handle"
+        }), 404
+
+    return jsonify({
+        "stats": cursor.stats()
+    })
+
+
+@app.route('/shark/cursor/stats')
+def cursor_stats():
+    """
+    Retrieves the hit, miss and eviction counters of
+    the cursor cache
+
+    Returns:
+        a json object containing cursor cache statistics
+    """
+
+    return jsonify({
+        "stats": cursors.stats()
+    })
+
+
 @app.route('/shark/resultfiles')
 def get_result_files():
     """
@@ -790,14 +1468,125 @@ def get_result_files():
     if error is not None:
         return error, None, None
 
-    accountObj = Account.query.filter(Account.id==account).first()
-    cursor = Cursor(accountObj.iam_username, accountObj.access_key_id,
-                    accountObj.access_key_secret, accountObj.region, handle)
+    cursor = makeCursor(account, handle)
 
     return jsonify({
         "files": cursor.queryFilesDownload()
     })
 
+
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+STREAM_BATCH_ROWS = 10000
+
+def streamRows(cursor, offset, rowFormat, compress):
+    """
+    Generates the rows of a cursor as chunks of NDJSON or CSV,
+    holding at most one batch of rows in memory at a time
+
+    Args:
+        cursor: a cursor over query results
+        offset: the number of rows to skip before streaming
+        rowFormat: either 'ndjson' or 'csv'
+        compress: whether to gzip the output
+    Returns:
+        a generator of output strings
+    """
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS) if compress else None
+
+    try:
+
+        while offset > 0:
+            skipped = cursor.fetchMany(min(offset, STREAM_BATCH_ROWS))
+            if not skipped:
+                break
+            offset -= len(skipped)
+
+        while True:
+
+            rows = cursor.fetchMany(STREAM_BATCH_ROWS)
+            if not rows:
+                break
+
+            if rowFormat == "csv":
+                buf = StringIO()
+                csv.writer(buf).writerows(rows)
+                chunk = buf.getvalue()
+            else:
+                chunk = "".join(["%s\n" % json.dumps(row) for row in rows])
+
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+
+            yield chunk
+
+        if compressor:
+            yield compressor.flush()
+
+    finally:
+
+        cursor.close()
+
+
+@app.route('/shark/results/stream')
+def stream_results():
+    """
+    Streams every row of a query's results as NDJSON or CSV.
+    Interrupted downloads can be resumed by row offset either
+    with the offset parameter or a 'Range: rows=<offset>-' header.
+
+    GetParams:
+        account: an account
+        user: a user
+        handle: a shark client handle
+        format: either 'ndjson' (the default) or 'csv'
+        offset: the number of rows to skip
+        gzip: set to 'true' to gzip the response
+    Returns:
+        a chunked response containing the query results
+    """
+
+    error, user, account, _, handle = getRequestParameters(forceHandle=True, forceCluster=False)
+    if error:
+        return jsonify(error), 400
+
+    rowFormat = request.args.get("format", "ndjson")
+    if rowFormat not in STREAM_FORMATS:
+        return jsonify({
+            "error": "Format must be one of: %s" % ", ".join(STREAM_FORMATS.keys())
+        }), 400
+
+    status = 200
+    offset = request.args.get("offset", "0")
+    if not offset.isdigit():
+        return jsonify({
+            "error": "offset must be a non-negative number of rows"
+        }), 400
+    offset = int(offset)
+    rangeMatch = re.match(r"^rows=(\d+)-$", request.headers.get("Range", ""))
+    if rangeMatch:
+        offset = int(rangeMatch.group(1))
+        status = 206
+
+    compress = request.args.get("gzip", "false").lower() == "true"
+
+    cursor = makeCursor(account, handle)
+
+    headers = {}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    if status == 206:
+        headers["Content-Range"] = "rows %s-*/*" % offset
+
+    return Response(stream_with_context(streamRows(cursor, offset, rowFormat, compress)),
+                    status=status, headers=headers, mimetype=STREAM_FORMATS[rowFormat])
+
 @app.route('/shark/fetchn/<number>')
 def fetch_number(number):
     """
@@ -809,12 +1598,19 @@ def fetch_number(number):
         account: an account
         user: a user
         handle: a shark client handle
+        format: 'json' (the default) or 'columnar' for a binary page
+            of typed column buffers, see lib/columnar.py
     Returns:
         A json object containing data, schema and the user supplied 
             handle
     """
 
-    data, statusCode = fetchN(int(number))
+    pageFormat = request.args.get("format", "json")
+
+    data, statusCode = fetchN(int(number), pageFormat)
+
+    if pageFormat == "columnar" and statusCode == 200:
+        return Response(data, mimetype=columnar.MIMETYPE)
 
     return jsonify(data), statusCode
 
@@ -837,6 +1633,54 @@ def status():
     return jsonify(data), statusCode
 
 
+@app.route('/shark/status/batch', methods=["GET", "POST"])
+def status_batch():
+    """
+    Fetches the status of many shark queries in one call
+
+    Get/PostParams:
+        account: an account
+        user: a user
+        cluster: the default cluster of the handles
+        handles: a json list of handles or {"handle", "cluster"} objects
+    Returns:
+        A json object mapping each handle to its status code and status
+    """
+
+    data, statusCode = fetchBatch(fetchQueryStatus)
+
+    if statusCode != 200:
+        return jsonify(data), statusCode
+
+    return jsonify({
+        "statuses": data
+    })
+
+
+@app.route('/shark/progress/batch', methods=["GET", "POST"])
+def progress_batch():
+    """
+    Fetches the progress of many shark queries in one call
+
+    Get/PostParams:
+        account: an account
+        user: a user
+        cluster: the default cluster of the handles
+        handles: a json list of handles or {"handle", "cluster"} objects
+    Returns:
+        A json object mapping each handle to its status code and progress
+    """
+
+    data, statusCode = fetchBatch(fetchQueryProgress)
+
+    if statusCode != 200:
+        return jsonify(data), statusCode
+
+    return jsonify({
+        "progress": data
+    })
+
+
 @app.route('/shark/progress')
 def progress():
     """
@@ -855,6 +1699,166 @@ def progress():
     return jsonify(data), statusCode
 
 
+@app.route('/shark/progress/wait')
+def progress_wait():
+    """
+    Long-polls the progress of a shark query, holding the request
+    until the progress changes or the timeout passes
+
+    GetParams:
+        account: an account
+        user: a user
+        cluster: a cluster
+        handle: a shark client handle
+        version: the last progress version the client has seen
+        timeout: the max number of seconds to wait (up to 60)
+    Returns:
+        A json object containing the query progress, its version and
+            whether the query has stopped running
+    """
+
+    error, user, account, cluster, handle = getRequestParameters(forceHandle=True)
+    if error:
+        return jsonify(error), 400
+
+    since = request.args.get("version", "0")
+    if not since.isdigit():
+        return jsonify({
+            "error": "version must be a non-negative progress version"
+        }), 400
+    since = int(since)
+
+    try:
+        timeout = float(request.args.get("timeout", 30))
+    except ValueError:
+        timeout = None
+    if timeout is None or math.isnan(timeout) or math.isinf(timeout) or timeout < 0:
+        return jsonify({
+            "error": "timeout must be a non-negative number of seconds"
+        }), 400
+    timeout = min(timeout, MAX_PROGRESS_WAIT)
+
+    data, statusCode, version, done = progressHub.wait((account, user, cluster, handle), since, timeout)
+
+    if statusCode is None:
+        return jsonify({
+            "error": "Timed out waiting for progress"
+        }), 504
+
+    if statusCode != 200:
+        return jsonify(data), statusCode
+
+    return jsonify({
+        "progress": data,
+        "version": version,
+        "done": done
+    })
+
+
+@app.route('/shark/progress/events')
+def progress_events():
+    """
+    Streams the progress of a shark query as server-sent events
+    until the query stops running
+
+    GetParams:
+        account: an account
+        user: a user
+        cluster: a cluster
+        handle: a shark client handle
+    Returns:
+        A text/event-stream of json progress updates
+    """
+
+    error, user, account, cluster, handle = getRequestParameters(forceHandle=True)
+    if error:
+        return jsonify(error), 400
+
+    since = request.headers.get("Last-Event-ID", "0")
+    if not since.isdigit():
+        return jsonify({
+            "error": "Last-Event-ID must be a non-negative progress version"
+        }), 400
+
+    key = (account, user, cluster, handle)
+
+    def events(since):
+
+        while True:
+
+            data, statusCode, version, done = progressHub.wait(key, since, SSE_KEEPALIVE)
+
+            if version > since:
+                since = version
+                yield "id: %s\ndata: %s\n\n" % (version, json.dumps(data))
+            else:
+                yield ": keepalive\n\n"
+
+            if done:
+                return
+
+    return Response(stream_with_context(events(int(since))), mimetype="text/event-stream")
+
+
+@app.route('/shark/progress/notify', methods=["POST"])
+def progress_notify():
+    """
+    Watches a job server handle and publishes an event on redis once
+    it stops running or turns out not to exist, so that callers don't
+    have to poll for it. Jobs that write to a table (e.g. imports) can
+    also have the table's version bumped now and once they stop, so
+    that results cached from the table while the job ran aren't reused.
+
+    PostParams:
+        account: an account
+        user: a user
+        cluster: a cluster
+        handle: a job server handle
+        table: (optional) a table the job writes to
+        channel: the redis channel to publish on (defaults to
+            JOB_EVENTS_CHANNEL, or to none when a table is given)
+    Returns:
+        An empty json object
+    """
+
+    global eventsClient
+
+    error, user, account, cluster, handle = getRequestParameters(forceHandle=True)
+    if error:
+        return jsonify(error), 400
+
+    table = request.form.get("table")
+    channel = request.form.get("channel", None if table else JOB_EVENTS_CHANNEL)
+
+    if table and redisClient is not None:
+        bumpTableVersion(redisClient, account, table)
+
+    if channel and eventsClient is None:
+        redisInfo = mixingboard.getConf('redis')
+        eventsClient = redis.StrictRedis(host=redisInfo['host'], port=int(redisInfo['port']), db=0)
+
+    client = eventsClient
+    def finished(data, statusCode):
+
+        # the table is bumped even if the hub gave up on the handle,
+        # since the job may have written to it in the meantime
+        if table and redisClient is not None:
+            bumpTableVersion(redisClient, account, table)
+
+        # handles upstream keeps failing for are left to the caller's
+        # own polling
+        if not channel or (statusCode != 404 and (statusCode != 200 or data.get("running", True))):
+            return
+        client.publish(channel, json.dumps({
+            "handle": handle,
+            "status": statusCode
+        }))
+
+    progressHub.notify((account, user, cluster, handle), finished)
+
+    return jsonify({})
+
+
 @app.route('/shark/results')
 def query_results():
     """
@@ -879,5 +1883,5 @@ def query_results():
 
 if __name__ == "__main__":
 
-    mixingboard.exposeService("shark", port=PORT)
+    mixingboard.exposeService("shark", port=PORT, sharedState=SHARED_CURSORS)
     app.run(debug=DEBUG, port=PORT, host=HOST, threaded=True)
@@ -2,19 +2,25 @@
 
 # Standard Library
 import argparse
+import copy
 import json
+import itertools
 import os
 import logging
+import random
 import socket
 import time
 import urllib
 import uuid
+from collections import defaultdict
+from threading import Lock, Timer
 
 # Third Party
 import requests
 import yaml
+from chassis import httpclient
 from kazoo.client import KazooClient, KazooState
-from kazoo.exceptions import NodeExistsError, NoNodeError
+from kazoo.exceptions import BadVersionError, NodeExistsError, NoNodeError
 
 # setup logging
 logging.basicConfig(level=logging.INFO)
@@ -27,11 +33,13 @@ argParser = argparse.ArgumentParser(description='Run the Quarry server.')
 argParser.add_argument('--mixing-board', type=str, default='mixingboard.yml', help='Set the mixingboard config file')
 argParser.add_argument('-c','--command', type=str, default='serve', help='Specify the command to run')
 argParser.add_argument('-r', '--region', type=str, default="us-east-1", help='Set the region to use')
+argParser.add_argument('--discovery-debounce', type=float, default=2.0, help='Seconds to coalesce service membership changes over before calling discovery callbacks')
 args, _ = argParser.parse_known_args()
 
 # put args in sensible all caps variables
 COMMAND = args.command
 REGION = args.region
+DISCOVERY_DEBOUNCE = args.discovery_debounce
 
 zk_hosts = []
 if "ZKHOSTS" in os.environ:
@@ -114,33 +122,60 @@ def makeNewCluster(account, name, **kwargs):
         return False
 
 
-def incrementClusterWorkers(account, cluster, incrAmount, lock=None):
+def _updateCluster(account, cluster, update):
+    """
+    Updates a cluster's data without taking the cluster lock. The
+    data is rewritten only if the node hasn't changed since it was
+    read (by comparing znode versions), otherwise the update is
+    retried against the new data.
+
+    Args:
+        account: an account id
+        cluster: a cluster name
+        update: a function that modifies the cluster data in place
+    Returns:
+        the updated cluster data
+    """
 
-    numWorkers = 0
     clusterNode = '/mixingboard/services_%s/clusters/%s' % (account, cluster)
-    if lock is None: 
-        lockNode = '%s/_lock_' % clusterNode
-        lock = zk.Lock(lockNode, clusterNode)
 
-    with lock:
-        clusterData = json.loads(zk.get(clusterNode)[0])
+    while True:
+
+        data, stat = zk.get(clusterNode)
+        clusterData = json.loads(data)
+        update(clusterData)
+
+        try:
+            zk.set(clusterNode, json.dumps(clusterData), version=stat.version)
+            return clusterData
+        except BadVersionError:
+            continue
+
+
+def incrementClusterWorkers(account, cluster, incrAmount):
+
+    def increment(clusterData):
         clusterData['workers'] = clusterData.get('workers',0) + incrAmount
-        zk.set(clusterNode, json.dumps(clusterData))
-        numWorkers = clusterData['workers']
-    return numWorkers
 
+    return _updateCluster(account, cluster, increment)['workers']
 
-def alterClusterProperty(account, cluster, propertyName, value, lock=None):
 
-    clusterNode = '/mixingboard/services_%s/clusters/%s' % (account, cluster)
-    if lock is None: 
-        lockNode = '%s/_lock_' % clusterNode
-        lock = zk.Lock(lockNode, clusterNode)
+def alterClusterProperties(account, cluster, properties):
+    """
+    Sets several properties of a cluster in a single write
+
+    Args:
+        account: an account id
+        cluster: a cluster name
+        properties: a dictionary of property names to values
+    """
+
+    _updateCluster(account, cluster, lambda clusterData: clusterData.update(properties))
+
 
-    with lock:
-        clusterData = json.loads(zk.get(clusterNode)[0])
-        clusterData[propertyName] = value
-        zk.set(clusterNode, json.dumps(clusterData))
+def alterClusterProperty(account, cluster, propertyName, value):
+
+    alterClusterProperties(account, cluster, {propertyName: value})
 
 
 def lockCluster(account, cluster):
@@ -157,43 +192,41 @@ def lockService(account, serviceName):
     return zk.Lock(lockNode, serviceNode)
 
 
-def _fetchAndProcessClusterInfo(account, cluster, serviceInfo=False):
+def leaderElection(name, identifier=None):
 
-    clusterNode = "/mixingboard/services_%s/clusters/%s" % (account, cluster)
-    try:
-        clusterInfo = json.loads(zk.get(clusterNode)[0])
-    except ValueError:
-        # if this cluster doesn't have a valid JSON
-        # representation, delete it
-        zk.delete(clusterNode, recursive=True)
-        return None
-
-    services = zk.get_children(clusterNode)
-    serviceInfos = {}
-    for service in services:
+    electionNode = '/mixingboard/elections/%s' % name
+    return zk.Election(electionNode, identifier)
 
-        serviceNode = "%s/%s" % (clusterNode, service)
-        instances = zk.get_children(serviceNode)
 
-        if serviceInfo:
+def _processClusterInfo(clusterInfo, serviceInstances, serviceInfo=False):
+    """
+    Fills in the service counts and status of a cluster
 
-            instanceInfos = {}
-            for instance in instances:
-                instanceNode = "%s/%s" % (serviceNode, instance)
-                instanceInfos[instance] = json.loads(zk.get(instanceNode)[0])
+    Args:
+        clusterInfo: the cluster's node data
+        serviceInstances: a dictionary of service name to a dictionary
+            of instance name to instance data (or None)
+        serviceInfo: include the instance data in the cluster info
+    Returns:
+        the cluster info
+    """
 
-        else:
+    serviceInfos = {}
+    for service, instances in serviceInstances.items():
 
-            if service.find('spark-worker') == 0:
-                service = 'spark-worker'
+        if service.find('spark-worker') == 0:
+            service = 'spark-worker'
 
-            try:
-                serviceInfos[service] += len(instances)
-            except KeyError:
-                serviceInfos[service] = len(instances)
+        try:
+            serviceInfos[service] += len(instances)
+        except KeyError:
+            serviceInfos[service] = len(instances)
 
     clusterInfo['services'] = serviceInfos
 
+    if serviceInfo:
+        clusterInfo['instances'] = serviceInstances
+
     clusterInfo['alive'] = (serviceInfos.get('job-server', 0) > 0) and (serviceInfos.get('spark-worker', 0) > 0) \
                              and (serviceInfos.get('spark-master', 0) > 0 and not clusterInfo.get("rebooting",False))
 
@@ -211,6 +244,102 @@ def _fetchAndProcessClusterInfo(account, cluster, serviceInfo=False):
     return clusterInfo
 
 
+def _fetchAndProcessClusterInfos(account, clusters, serviceInfo=False, ignoreMissing=True):
+    """
+    Reads the node trees of several clusters at once. Each level of
+    the tree is requested asynchronously for every cluster before
+    waiting on any of the results, so reading any number of clusters
+    takes a fixed number of round trips to zookeeper.
+
+    Args:
+        account: an account id
+        clusters: a list of cluster names
+        serviceInfo: also read and include the data of each service instance
+        ignoreMissing: skip clusters that don't exist or were deleted
+            while being read, otherwise a NoNodeError is raised. Services
+            and instances that go away while being read are always skipped.
+    Returns:
+        a list of cluster infos in the same order as the clusters,
+        with None for any clusters that couldn't be read
+    """
+
+    def wait(asyncResult, required=False):
+        try:
+            return asyncResult.get()
+        except NoNodeError:
+            if required and not ignoreMissing:
+                raise
+            return None
+
+    clusterNodes = ["/mixingboard/services_%s/clusters/%s" % (account, cluster) for cluster in clusters]
+
+    # read every cluster node and its services
+    clusterRequests = [(zk.get_async(clusterNode), zk.get_children_async(clusterNode))
+                       for clusterNode in clusterNodes]
+
+    clusterInfos = []
+    clusterServices = []
+    for clusterNode, (dataRequest, childrenRequest) in zip(clusterNodes, clusterRequests):
+
+        data = wait(dataRequest, required=True)
+        services = wait(childrenRequest, required=True)
+
+        clusterInfo = None
+        if data is not None and services is not None:
+            try:
+                clusterInfo = json.loads(data[0])
+            except ValueError:
+                # if this cluster doesn't have a valid JSON
+                # representation, delete it
+                zk.delete(clusterNode, recursive=True)
+
+        clusterInfos.append(clusterInfo)
+        clusterServices.append(services if clusterInfo is not None else [])
+
+    # read the instances of every service
+    serviceRequests = [
+        [(service, zk.get_children_async("%s/%s" % (clusterNode, service))) for service in services]
+        for clusterNode, services in zip(clusterNodes, clusterServices)
+    ]
+
+    serviceInstances = []
+    for pending in serviceRequests:
+        instances = {}
+        for service, childrenRequest in pending:
+            children = wait(childrenRequest)
+            if children is not None:
+                instances[service] = dict((instance, None) for instance in children)
+        serviceInstances.append(instances)
+
+    # read the data of every instance
+    if serviceInfo:
+
+        instanceRequests = [
+            (instances, service, instance,
+             zk.get_async("%s/%s/%s" % (clusterNode, service, instance)))
+            for clusterNode, instances in zip(clusterNodes, serviceInstances)
+            for service in instances
+            for instance in instances[service]
+        ]
+
+        for instances, service, instance, dataRequest in instanceRequests:
+            data = wait(dataRequest)
+            if data is None:
+                del instances[service][instance]
+            else:
+                instances[service][instance] = json.loads(data[0])
+
+    return [
+        _processClusterInfo(clusterInfo, instances, serviceInfo) if clusterInfo is not None else None
+        for clusterInfo, instances in zip(clusterInfos, serviceInstances)
+    ]
+
+
+def _fetchAndProcessClusterInfo(account, cluster, serviceInfo=False):
+
+    return _fetchAndProcessClusterInfos(account, [cluster], serviceInfo, ignoreMissing=False)[0]
+
+
 def listClusters(account, serviceInfo=False):
 
     nodeName = '/mixingboard/services_%s/clusters' % account
@@ -222,7 +351,7 @@ def listClusters(account, serviceInfo=False):
 
     clusterInfos = filter(
         lambda x: x is not None, 
-        [_fetchAndProcessClusterInfo(account, cluster, serviceInfo) for cluster in clusters]
+        _fetchAndProcessClusterInfos(account, clusters, serviceInfo)
     )
 
     return {
@@ -285,6 +414,7 @@ def exposeService(serviceName, port=None, account=None, user=None, cluster=None,
 
 
 def unexposeService(serviceName, port=None, account=None, user=None, cluster=None):
+    global exposedServices
 
     nodeName = ""
     if account:
@@ -305,6 +435,8 @@ def unexposeService(serviceName, port=None, account=None, user=None, cluster=Non
     except:
         pass
 
+    exposedServices.pop(serviceName, None)
+
 
 def listAvailableServices(account=None, cluster=None, user=None):
 
@@ -324,6 +456,85 @@ def listAvailableServices(account=None, cluster=None, user=None):
             return zk.get_children('/mixingboard/services')
 
 
+def _serviceNodeName(serviceName, account=None, cluster=None):
+
+    if account:
+
+        if cluster:
+
+            return '/mixingboard/services_%s/clusters/%s/%s' % (
+                account,
+                cluster,
+                serviceName
+            )
+
+        else:
+
+            return '/mixingboard/services_%s/%s' % (account, serviceName)
+
+    else:
+
+        return '/mixingboard/services/%s' % (serviceName)
+
+
+def _unpackServiceNode(data):
+
+    serviceNode = json.loads(data)
+    if EXTERNAL and 'externalHost' in serviceNode:
+        serviceNode['host'] = serviceNode['externalHost']
+        del serviceNode['externalHost']
+
+    return serviceNode
+
+
+# service instances by service node name, kept current by zookeeper
+# watches that are registered the first time a service is looked up
+global serviceCache
+serviceCache = {}
+serviceCacheLock = Lock()
+serviceWatchLock = Lock()
+
+
+def _watchService(nodeName):
+
+    instances = {}
+    watchedChildren = set()
+
+    def watchChild(child):
+
+        @zk.DataWatch("%s/%s" % (nodeName, child))
+        def updateChild(data, stat):
+            with serviceCacheLock:
+                if stat is None:
+                    instances.pop(child, None)
+                    watchedChildren.discard(child)
+                    return False
+                instances[child] = _unpackServiceNode(data)
+
+    @zk.ChildrenWatch(nodeName)
+    def updateChildren(children):
+        for child in children:
+            if child not in watchedChildren:
+                watchedChildren.add(child)
+                watchChild(child)
+        with serviceCacheLock:
+            for child in instances.keys():
+                if child not in children:
+                    del instances[child]
+
+    @zk.DataWatch(nodeName)
+    def updateService(data, stat):
+        # forget the service if its node goes away so that the
+        # next lookup registers fresh watches
+        if stat is None:
+            with serviceCacheLock:
+                if serviceCache.get(nodeName) is instances:
+                    del serviceCache[nodeName]
+            return False
+
+    return instances
+
+
 def getService(serviceName, account=None, cluster=None, user=None):
 
     if serviceName in localServices:
@@ -332,37 +543,46 @@ def getService(serviceName, account=None, cluster=None, user=None):
 
     else:
 
-        nodeName = ""
-        if account:
+        nodeName = _serviceNodeName(serviceName, account, cluster)
 
-            if cluster:
+        with serviceCacheLock:
+            instances = serviceCache.get(nodeName)
 
-                nodeName = '/mixingboard/services_%s/clusters/%s/%s' % (
-                    account,
-                    cluster,
-                    serviceName
-                )
+        if instances is None:
 
-            else:
+            with serviceWatchLock:
 
-                nodeName = '/mixingboard/services_%s/%s' % (account, serviceName)
+                with serviceCacheLock:
+                    instances = serviceCache.get(nodeName)
 
-        else:
-            nodeName = '/mixingboard/services/%s' % (serviceName)
+                if instances is None:
 
-        childNodes = zk.get_children(nodeName)
+                    if not zk.exists(nodeName):
+                        raise NoNodeError(nodeName)
 
-        serviceNodes = []
-        for childNode in childNodes:
-            serviceNode = json.loads(zk.get("%s/%s" % (nodeName, childNode))[0])
-            if EXTERNAL and 'externalHost' in serviceNode:
-                serviceNode['host'] = serviceNode['externalHost']
-                del serviceNode['externalHost']
-            serviceNodes.append(serviceNode)
+                    instances = _watchService(nodeName)
+                    with serviceCacheLock:
+                        serviceCache[nodeName] = instances
 
-        return serviceNodes
+        with serviceCacheLock:
+            return [dict(instances[child]) for child in sorted(instances.keys())]
 
-def discoverService(serviceName, onDiscover, account=None, cluster=None, user=None):
+
+def discoverService(serviceName, onDiscover, account=None, cluster=None, user=None, debounce=None):
+    """
+    Calls onDiscover with the instances of a service now and whenever
+    they change. The first call is made before this returns. Later
+    changes that happen within the debounce window of the first one are
+    coalesced into one call, which is made on its own thread and skipped
+    if the instances are the same as the last call's.
+
+    Args:
+        serviceName: the name of the service
+        onDiscover: a function that takes a list of service instances
+        account: an account for account level services
+        cluster: a cluster for cluster level services
+        debounce: seconds to coalesce changes over, defaults to DISCOVERY_DEBOUNCE
+    """
 
     if serviceName in localServices:
 
@@ -370,38 +590,268 @@ def discoverService(serviceName, onDiscover, account=None, cluster=None, user=No
 
     else:
 
-        nodeName = ""
-        if account:
+        if debounce is None:
+            debounce = DISCOVERY_DEBOUNCE
 
-            if cluster:
+        nodeName = _serviceNodeName(serviceName, account, cluster)
 
-                nodeName = '/mixingboard/services_%s/clusters/%s/%s' % (
-                    account,
-                    cluster,
-                    serviceName
-                )
+        zk.ensure_path(nodeName)
 
-            else:
+        state = {
+            "children": [],
+            "timer": None,
+            "discovered": None,
+            "watching": False
+        }
+        stateLock = Lock()
+        # only one callback runs at a time, in the order of changes
+        discoverLock = Lock()
 
-                nodeName = '/mixingboard/services_%s/%s' % (account, serviceName)
+        def discover():
 
-        else:
-            nodeName = '/mixingboard/services/%s' % (serviceName)
+            with discoverLock:
 
-        zk.ensure_path(nodeName)
+                with stateLock:
+                    children = sorted(state["children"])
+                    state["timer"] = None
+
+                # fetch every instance before waiting on any of them
+                dataRequests = [zk.get_async("%s/%s" % (nodeName, child)) for child in children]
+
+                childData = []
+                for dataRequest in dataRequests:
+                    try:
+                        childData.append(_unpackServiceNode(dataRequest.get()[0]))
+                    except NoNodeError:
+                        pass
+
+                # the service going away entirely isn't reported, but
+                # its instances are rediscovered when it comes back
+                if len(childData) == 0:
+                    state["discovered"] = None
+                    return
+
+                if childData == state["discovered"]:
+                    return
+
+                state["discovered"] = childData
+
+                try:
+                    onDiscover([dict(data) for data in childData])
+                except Exception:
+                    logger.exception("Error handling discovery of service '%s'" % serviceName)
 
         @zk.ChildrenWatch(nodeName)
         def unpack(children):
-            if len(children) == 0:
-                return
-            childData = []
-            for child in children:
-                serviceNode = json.loads(zk.get("%s/%s" % (nodeName, child))[0])
-                if EXTERNAL and 'externalHost' in serviceNode:
-                    serviceNode['host'] = serviceNode['externalHost']
-                    del serviceNode['externalHost']
-                childData.append(serviceNode)
-            onDiscover(childData)
+            with stateLock:
+                state["children"] = children
+                first = not state["watching"]
+                state["watching"] = True
+                if not first and state["timer"] is None:
+                    state["timer"] = Timer(debounce, discover)
+                    state["timer"].daemon = True
+                    state["timer"].start()
+            # the watch reports the current instances while it's being
+            # set up, those are handed over right away so callers can
+            # use them as soon as discoverService returns
+            if first:
+                discover()
+
+
+##
+# CLIENT SIDE LOAD BALANCING
+##
+
+
+# seconds an instance is skipped after it refuses a connection
+EJECT_SECONDS = 10
+MAX_ATTEMPTS = 3
+
+
+class ServiceBalancer():
+    """
+    Spreads requests for a service over all of its exposed instances.
+
+    Strategies:
+        p2c: pick two random instances and use the one with fewer
+            requests in flight (the default)
+        least_outstanding: use the instance with the fewest requests in flight
+        round_robin: cycle through the instances
+        first: always use the first healthy instance, for services
+            that keep per-instance state such as the job server
+        sticky: use p2c if every instance is exposed with sharedState
+            set, and first otherwise, for services whose per-instance
+            state can optionally be shared such as markcuban's cursors
+    """
+
+    def __init__(self, serviceName, path="", account=None, cluster=None, strategy="p2c"):
+        self.serviceName = serviceName
+        self.path = path
+        self.account = account
+        self.cluster = cluster
+        self.strategy = strategy
+        self.outstanding = defaultdict(int)
+        self.ejected = {}
+        self.counter = itertools.count()
+        self.lock = Lock()
+
+    def _instanceKey(self, server):
+
+        return "%s:%s" % (server['host'], server['port'])
+
+    def instances(self):
+
+        servers = getService(self.serviceName, account=self.account, cluster=self.cluster)
+
+        now = time.time()
+        healthy = [server for server in servers if self.ejected.get(self._instanceKey(server), 0) <= now]
+
+        # if every instance has been ejected, try them all rather than failing outright
+        return healthy or servers
+
+    def pick(self):
+
+        servers = self.instances()
+        if len(servers) == 0:
+            raise Exception("No instances of the service '%s' are available" % self.serviceName)
+
+        with self.lock:
+
+            if len(servers) == 1 or self.strategy == "first":
+                return servers[0]
+
+            elif self.strategy == "sticky" and not all([server.get('sharedState') for server in servers]):
+                return servers[0]
+
+            elif self.strategy == "round_robin":
+                return servers[self.counter.next() % len(servers)]
+
+            elif self.strategy == "least_outstanding":
+                return min(servers, key=lambda server: self.outstanding[self._instanceKey(server)])
+
+            else:
+                first, second = random.sample(servers, 2)
+                if self.outstanding[self._instanceKey(first)] <= self.outstanding[self._instanceKey(second)]:
+                    return first
+                return second
+
+    def url(self, server=None):
+
+        if server is None:
+            server = self.pick()
+
+        return "http://%s:%s%s" % (server['host'], server['port'], self.path)
+
+    def eject(self, server):
+
+        with self.lock:
+            self.ejected[self._instanceKey(server)] = time.time() + EJECT_SECONDS
+
+        logger.warning("Ejected %s instance %s" % (self.serviceName, self._instanceKey(server)))
+
+    def request(self, method, path="", **kwargs):
+        """
+        Sends a request to an instance of the service. An instance that
+        can't be connected to is ejected for a while, and idempotent
+        requests move on to another instance while the retry budget allows.
+
+        Args:
+            method: an http method
+            path: a path relative to the balancer's base path
+            kwargs: any other arguments accepted by requests
+        Returns:
+            a requests response
+        """
+
+        attempts = MAX_ATTEMPTS if method.upper() in httpclient.IDEMPOTENT_METHODS else 1
+
+        attempt = 0
+        while True:
+
+            server = self.pick()
+            instanceKey = self._instanceKey(server)
+
+            with self.lock:
+                self.outstanding[instanceKey] += 1
+
+            try:
+
+                return httpclient.request(method, "%s%s" % (self.url(server), path), retries=0, **kwargs)
+
+            except requests.exceptions.ConnectionError:
+
+                self.eject(server)
+
+                attempt += 1
+                if attempt >= attempts or not httpclient.withdrawRetry():
+                    raise
+
+            finally:
+
+                with self.lock:
+                    self.outstanding[instanceKey] -= 1
+
+    def get(self, path="", **kwargs):
+
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path="", data=None, **kwargs):
+
+        return self.request("POST", path, data=data, **kwargs)
+
+
+global balancers
+balancers = {}
+balancersLock = Lock()
+
+
+def getBalancer(serviceName, path="", account=None, cluster=None, strategy="p2c"):
+    """
+    Retrieves a shared balancer for a service
+
+    Args:
+        serviceName: the name of the service
+        path: the base path of the service's urls, e.g. '/shark'
+        account: an account for account level services
+        cluster: a cluster for cluster level services
+        strategy: see ServiceBalancer
+    Returns:
+        a ServiceBalancer
+    """
+
+    key = (serviceName, path, account, cluster, strategy)
+
+    with balancersLock:
+
+        if key not in balancers:
+            balancers[key] = ServiceBalancer(serviceName, path, account=account,
+                                             cluster=cluster, strategy=strategy)
+
+        return balancers[key]
+
+
+def getSharkBalancer(path="/shark"):
+    """
+    Retrieves the balancer for markcuban. Cursors live in the process
+    that created them unless markcuban runs with shared cursors, so
+    requests only spread over instances once every instance shares them.
+
+    Args:
+        path: the base path of the service's urls
+    Returns:
+        a ServiceBalancer
+    """
+
+    return getBalancer("shark", path, strategy="sticky")
+
+
+def _confNodeName(key, account=None):
+
+    if account:
+        # TODO add cluster semantics
+        return '/mixingboard/config_%s/%s' % (account, key)
+    else:
+        return '/mixingboard/config/%s' % (key)
 
 
 def setConf(key, value, account=None, cluster=None, user=None):
@@ -410,12 +860,7 @@ def setConf(key, value, account=None, cluster=None, user=None):
         "value": value
     })
 
-    nodeName = ''
-    if account:
-        # TODO add cluster semantics
-        nodeName = '/mixingboard/config_%s/%s' % (account, key)
-    else:
-        nodeName = '/mixingboard/config/%s' % (key)
+    nodeName = _confNodeName(key, account)
 
     try:
         zk.create(nodeName, value=jsonValue, makepath=True)
@@ -423,7 +868,98 @@ def setConf(key, value, account=None, cluster=None, user=None):
         zk.set(nodeName, value=jsonValue)
 
 
+# config values by node name, kept current by zookeeper watches. The
+# global values are all loaded when mixingboard starts, account level
+# values and keys added later are watched the first time they're read.
+# Values that aren't valid config json are kept as their decode error.
+global confCache
+confCache = {}
+confErrors = {}
+confWatched = set()
+confWatchLock = Lock()
+
+
+def _watchConfNode(nodeName):
+    """
+    Keeps a config node's value in the config cache. Must be
+    called with confWatchLock held.
+    """
+
+    @zk.DataWatch(nodeName)
+    def update(data, stat):
+
+        if stat is None:
+            confCache.pop(nodeName, None)
+            confErrors.pop(nodeName, None)
+            return
+
+        try:
+            confCache[nodeName] = json.loads(data)['value']
+            confErrors.pop(nodeName, None)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Couldn't decode config node '%s': %s" % (nodeName, e))
+            confCache.pop(nodeName, None)
+            confErrors[nodeName] = str(e)
+
+    confWatched.add(nodeName)
+
+
+def loadConf():
+    """
+    Loads every global config value into the config cache, so that
+    reading them never waits on zookeeper
+    """
+
+    try:
+        keys = zk.get_children('/mixingboard/config')
+    except NoNodeError:
+        return
+
+    with confWatchLock:
+        for key in keys:
+            nodeName = _confNodeName(key)
+            if nodeName not in confWatched:
+                _watchConfNode(nodeName)
+
+
+def _cachedConf(key, account=None):
+
+    nodeName = _confNodeName(key, account)
+
+    if nodeName not in confWatched:
+
+        with confWatchLock:
+
+            if nodeName not in confWatched:
+                # the watch fills in the cache before returning
+                _watchConfNode(nodeName)
+
+    try:
+        value = confCache[nodeName]
+    except KeyError:
+        if nodeName in confErrors:
+            raise ValueError("Config node '%s' isn't valid config json: %s" % (nodeName, confErrors[nodeName]))
+        raise NoNodeError(nodeName)
+
+    # callers may modify what they're given
+    if isinstance(value, (dict, list)):
+        value = copy.deepcopy(value)
+
+    return value
+
+
 def getConf(key, account=None, cluster=None, user=None):
+    """
+    Retrieves a config value from the config cache, which is kept
+    current with zookeeper watches, so values stay readable through
+    brief zookeeper outages.
+
+    Args:
+        key: the config key
+        account: an account for account level config
+    Returns:
+        the config value
+    """
 
     if localConf:
 
@@ -437,42 +973,120 @@ def getConf(key, account=None, cluster=None, user=None):
 
     else:
 
-        if account:
+        return _cachedConf(key, account)
 
-            # TODO add cluster semantics
-            return json.loads(zk.get('/mixingboard/config_%s/%s' % (account, key))[0])['value']
 
-        else:
+def getConfMany(keys, account=None, cluster=None, user=None):
+    """
+    Retrieves several config values at once
 
-            return json.loads(zk.get('/mixingboard/config/%s' % (key))[0])['value']
+    Args:
+        keys: a list of config keys
+        account: an account for account level config
+    Returns:
+        a dictionary of config key to value
+    """
 
+    return {
+        key: getConf(key, account=account, cluster=cluster, user=user)
+        for key in keys
+    }
 
-def watchConf(key, onChange, account=None, cluster=None, user=None):
 
-    nodeName = ""
-    if account:
-        # TODO add cluster semantics
-        nodeName = '/mixingboard/config_%s/%s' % (accoun, key)
-    else:
-        nodeName = '/mixingboard/config/%s' % (key)
+def watchConf(key, onChange, account=None, cluster=None, user=None, onDelete=None):
+    """
+    Calls onChange with a config value now and whenever it changes
+
+    Args:
+        key: the config key
+        onChange: a function that takes the new value
+        account: an account for account level config
+        onDelete: a function called with no arguments if the value is deleted
+    """
+
+    nodeName = _confNodeName(key, account)
 
     @zk.DataWatch(nodeName)
     def unpack(data, stat):
+        if stat is None:
+            if onDelete is not None:
+                onDelete()
+            return
         onChange(json.loads(data)['value'])
 
 
 def deleteConf(key, account=None, cluster=None, user=None):
 
-    nodeName = ""
-    if account:
-        # TODO add cluster semantics
-        nodeName = '/mixingboard/config_%s/%s' % (account, key)
-    else:
-        nodeName = '/mixingboard/config/%s' % (key)
+    nodeName = _confNodeName(key, account)
 
     zk.delete(nodeName)
 
 
+if not localConf:
+    loadConf()
+
+
+# the monitor runs unprivileged, so it can only use supervisord's socket
+# if supervisord.conf lets it, e.g.
+#
+#   [unix_http_server]
+#   file=/var/run/supervisor.sock
+#   chmod=0770
+#   chown=root:quarry
+#
+# with the monitor's user in that group. Otherwise the monitor falls back
+# to 'sudo supervisorctl status' for as long as it runs.
+SUPERVISOR_SOCKET = "/var/run/supervisor.sock"
+
+# seconds between checks of the local services, and between
+# re-registering every service in case zookeeper has drifted
+MONITOR_INTERVAL = 5
+MONITOR_RESYNC_INTERVAL = 300
+
+
+def _supervisorStatuses():
+    """
+    Retrieves the state of every process supervisord is running, asking
+    supervisord over its XML-RPC socket rather than starting supervisorctl
+
+    Returns:
+        a dictionary of process name (as shown by supervisorctl status) to state
+    """
+
+    import httplib
+    import xmlrpclib
+
+    class UnixStreamHTTPConnection(httplib.HTTPConnection):
+
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(SUPERVISOR_SOCKET)
+
+    class UnixStreamTransport(xmlrpclib.Transport):
+
+        def make_connection(self, host):
+            return UnixStreamHTTPConnection("localhost")
+
+    supervisor = xmlrpclib.ServerProxy("http://localhost", transport=UnixStreamTransport())
+
+    return {
+        info['name'] if info['group'] == info['name'] else "%s:%s" % (info['group'], info['name']): info['statename']
+        for info in supervisor.supervisor.getAllProcessInfo()
+    }
+
+
+def _supervisorctlStatuses():
+
+    import subprocess
+
+    lines = subprocess.Popen(["sudo", "supervisorctl","status"],stdout=subprocess.PIPE).communicate()[0].split("\n")[:-1]
+    lines = [filter(lambda x: x, line.split(" "))[:2] for line in lines]
+    return {
+        line[0]: line[1]
+        for line in lines
+    }
+
+
 def monitor(userData=None):
 
     import subprocess
@@ -632,15 +1246,38 @@ def monitor(userData=None):
         alterClusterProperty(account, cluster, "rebooting", False)
 
     logger.info("MONITORING LOCAL SERVICES")
+
+    # the last known running state of each process, zookeeper is
+    # only written to when a process starts or stops
+    running = {}
+    lastResync = time.time()
+
+    # stick with whichever way of reading statuses works at startup
+    getStatuses = _supervisorStatuses
+    try:
+        _supervisorStatuses()
+    except Exception as e:
+        logger.warning("Couldn't reach supervisord at %s, using supervisorctl instead: %s" % (SUPERVISOR_SOCKET, e))
+        getStatuses = _supervisorctlStatuses
+
     while True:
 
-        lines = subprocess.Popen(["sudo", "supervisorctl","status"],stdout=subprocess.PIPE).communicate()[0].split("\n")[:-1]
-        lines = [filter(lambda x: x, line.split(" "))[:2] for line in lines]
-        print lines
-        supervisorStatuses = {
-            line[0]: line[1]
-            for line in lines
-        }
+        if time.time() - lastResync > MONITOR_RESYNC_INTERVAL:
+            running = {}
+            lastResync = time.time()
+
+        try:
+            supervisorStatuses = getStatuses()
+        except Exception as e:
+            # e.g. supervisord is restarting, check again on the next pass
+            logger.error("Couldn't read process statuses from supervisord: %s" % e)
+            time.sleep(MONITOR_INTERVAL)
+            continue
+
+        # processes that have gone away entirely are no longer running
+        for service in running.keys():
+            if service not in supervisorStatuses:
+                supervisorStatuses[service] = "STOPPED"
 
         for service, status in supervisorStatuses.items():
             
@@ -649,14 +1286,20 @@ def monitor(userData=None):
             if serviceParts[0] not in PROCESS_TYPES.keys():
                 continue
 
-            if status == "RUNNING":
+            isRunning = status == "RUNNING"
+            if running.get(service) == isRunning:
+                continue
+
+            if isRunning:
                 exposeService(serviceParts[-1], PROCESS_TYPES[serviceParts[0]], account=account, 
                               cluster=cluster if serviceParts[-1] != "streamer" else None)
             else:
                 unexposeService(serviceParts[-1], PROCESS_TYPES[serviceParts[0]], account=account,
                                 cluster=cluster if serviceParts[-1] != "streamer" else None)
 
-        time.sleep(5)
+            running[service] = isRunning
+
+        time.sleep(MONITOR_INTERVAL)
 
 
 def serve():
@@ -378,8 +378,10 @@ def launch_cluster():
 
     error, launchedInstances, openedSpots = launchInstances(user, account, groups + workerGroups, cluster=clusterName, launchCluster=True)
 
-    mixingboard.alterClusterProperty(account, clusterName, "workers", workers)
-    mixingboard.alterClusterProperty(account, clusterName, "groups", groups)
+    mixingboard.alterClusterProperties(account, clusterName, {
+        "workers": workers,
+        "groups": groups
+    })
 
     if error:
 
@@ -508,7 +510,7 @@ def cluster_alter_workers(cluster, workers):
 
     with lock: 
 
-        mixingboard.alterClusterProperty(account, cluster, 'workers', workers, lock=lock)
+        mixingboard.alterClusterProperty(account, cluster, 'workers', workers)
 
         # check if the cluster is stopped
         clusterInfo = mixingboard.getCluster(account, cluster)
@@ -728,7 +730,7 @@ def cluster_start(cluster):
     with lock: 
 
         clusterInfo = mixingboard.getCluster(account, cluster)
-        mixingboard.alterClusterProperty(account, cluster, "stopped", False, lock=lock)
+        mixingboard.alterClusterProperty(account, cluster, "stopped", False)
 
         workerGroups = buildGroupsForWorkers(clusterInfo['workers'])
 